@@ -4,23 +4,47 @@ Ready to go plans for managing your trades.
 WARNING: Use at your own risk!
 No promise of financial gain is made, and any losses from use of this software are your responsibility.
 """
+import argparse
+import threading
 import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 from ledger import Amount
 from tappmq.tappmq import get_running_workers
-from trade_manager.plugin import get_balances, get_market_vol_shares, get_usd_value, red, create_order, sync_balances
+from trade_manager import EXCHANGES, get_session, get_scoped_session
+from trade_manager.plugin import get_balances, get_all_market_vol_shares, get_usd_value, get_redis, \
+    reconcile_ladder, sync_balances, get_active_markets, get_tickers, iter_orders, PriceSnapshot, TickerSubscriber
+from trade_manager.reconcile import locked_amounts
 
 MINMM = Amount("5 USD")
 MINORDER = Amount("1 USD")
+# the most exchanges to run at once
+MM_WORKERS = 4
+# seconds a cycle waits for all exchanges before reporting the stragglers
+MM_DEADLINE = 60.0
+# seconds a one shot run waits, past the deadline, for timed out exchanges to finish before exiting
+MM_STRAGGLER_CAP = 300.0
+# seconds after a cycle during which balance changes are put down to its own orders settling
+BALANCE_SETTLE = 30.0
+# seconds computed volume shares are reused, since they follow 24 hour volumes
+VOL_SHARES_TTL = 60.0
+# exchange -> (computed time, volume shares)
+_vol_shares = {}
 
 
-def fib_fan(side, amount, ticker, session):
+def fib_fan(side, amount, ticker, session, snapshot=None):
+    """
+    Fan amount out over a ladder of orders on one side of the ticker's market, spaced by the fibonacci sequence.
+
+    :param PriceSnapshot snapshot: The snapshot the amount was sized from, to value it at the same tick. (optional)
+    """
     def calc_price(sid, index, offset):
         if sid == 'ask':
             return index * (Amount("1 %s" % index.commodity) + Amount("%s %s" % (offset, index.commodity)) / 100)
         else:
             return index * (Amount("1 %s" % index.commodity) - Amount("%s %s" % (offset, index.commodity)) / 100)
 
-    usdamount = get_usd_value(amount)
+    usdamount = get_usd_value(amount, snapshot=snapshot)
     if usdamount <= MINORDER:
         print "ignoring dusty order %s worth %s" % (usdamount, usdamount)
         return
@@ -35,61 +59,337 @@ def fib_fan(side, amount, ticker, session):
         # usdval = get_usd_value(amount)
         # print "{0} {1} @ {2:0.6f} {3} worth ${4:0.2f})".format(side, amount, price.to_double(), ticker.market,
         #                                                        usdval.to_double())
-        create_order(ticker.exchange, price=price, amount=amount, market=ticker.market, side=side, session=session)
+        reconcile_ladder(ticker.exchange, ticker.market, side, [(price, amount)], session)
     else:
         if side == 'bid':
             amount = Amount("{0:.8f} {1}".format((amount / len(fibseq)).to_double(), base)) / \
                      Amount("{0:.8f} {1}".format(index.to_double(), base))
         else:
             amount /= len(fibseq)
+        ladder = []
         for fib in fibseq:
             price = calc_price(side, index, fib)
-            create_order(ticker.exchange, price=price, amount=amount, market=ticker.market, side=side, session=session)
+            ladder.append((price, amount))
             # usdval = get_usd_value(amount) * price / index
             # print "{0} {1} @ {2:0.6f} {3} worth ${4:0.2f})".format(side, amount, price.to_double(),
             #                                                        ticker.market, usdval.to_double())
+        reconcile_ladder(ticker.exchange, ticker.market, side, ladder, session)
     sync_balances(ticker.exchange)
 
 
-def mm(exchange, callback, session):
+def get_vol_shares(exchange, snapshot):
+    """
+    Get the volume shares of every commodity on an exchange, reusing them for VOL_SHARES_TTL seconds.
+    Reused shares get the snapshot's tickers, so orders are always priced from the current tick.
+    """
+    computed, allshares = _vol_shares.get(exchange, (0.0, None))
+    if allshares is None or time.time() - computed >= VOL_SHARES_TTL:
+        allshares = get_all_market_vol_shares(exchange, snapshot=snapshot)
+        _vol_shares[exchange] = (time.time(), allshares)
+        return allshares
+    for vshares in allshares.values():
+        for market in vshares:
+            if market != 'total':
+                vshares[market]['ticker'] = snapshot.get_ticker(exchange, market)
+    return allshares
+
+
+def mm(exchange, callback, session, timings=None):
+    """
+    :param dict timings: If given, the seconds spent in each phase are added to it. (optional)
+    """
+    timings = timings if timings is not None else {}
     print "__________%s mm %s__________" % (exchange, time.asctime(time.gmtime(time.time())))
+    start = time.time()
     bals = get_balances(exchange, session=session)
+    timings['balances'] = time.time() - start
     if bals is not None:
+        # size ladders from the available funds plus those held by the open orders being reconciled,
+        # so orders that are already in place don't shrink the next ladder
         available = bals[1]
+        orders = []
+        for state in ('pending', 'open'):
+            orders.extend(iter_orders(exchange.lower(), state=state, session=session))
+        for comm, locked in locked_amounts(orders).items():
+            available = available + Amount("{0:.8f} {1}".format(locked, comm))
+        start = time.time()
+        snapshot = PriceSnapshot(commodities=[str(amount.commodity) for amount in available],
+                                 pairs=[(exchange, market) for market in get_active_markets(exchange)])
+        allshares = get_vol_shares(exchange, snapshot)
+        timings['prices'] = time.time() - start
+        start = time.time()
         for amount in available:
             comm = str(amount.commodity)
             try:
-                value = get_usd_value(amount)
+                value = get_usd_value(amount, snapshot=snapshot)
             except TypeError as e:
                 print e
                 continue
             if value <= MINMM:
                 print "ignoring dusty %s worth %s" % (amount, value)
                 continue
-            vshares = get_market_vol_shares(exchange, comm)
+            vshares = allshares.get(comm)
+            if vshares is None:
+                print "no priced markets for %s on %s" % (comm, exchange)
+                continue
             for market in vshares:
                 if market == 'total':
                     continue
                 vshare = vshares[market]['vol_share']
                 if market.find(comm) == 0:  # amount is base, so we sell
                     tosell = amount * Amount("%s %s" % (vshare, comm))
-                    tosellval = get_usd_value(tosell)
                     # print "sell {0} out of {1} on {2} ({3:0.2f}% worth ${4:0.2f})".format(tosell, amount, market,
                     #                                                                       vshare * 100,
                     #                                                                       tosellval.to_double())
-                    callback('ask', tosell, vshares[market]['ticker'], session)
+                    callback('ask', tosell, vshares[market]['ticker'], session, snapshot)
                 if market.find(comm) >= 3:  # amount is quote, so we buy
                     base = market.split("_")[1]
                     tobuy = Amount("%s %s" % (amount, base)) * Amount("%s %s" % (vshare, base))
-                    tobuyval = get_usd_value(tobuy)
                     # print "spend {0} out of {1} on {2} ({3:0.2f}% worth ${4:0.2f})".format(tobuy, amount, market,
                     #                                                                        vshare * 100,
                     #                                                                        tobuyval.to_double())
-                    callback('bid', tobuy, vshares[market]['ticker'], session)
+                    callback('bid', tobuy, vshares[market]['ticker'], session, snapshot)
+        timings['orders'] = time.time() - start
 
 
-if __name__ == "__main__":
-    from trade_manager import ses, EXCHANGES, ses, ses
+def run_exchange(exchange, callback):
+    """
+    Run mm for one exchange, with this thread's own session.
+
+    :return: A dict of the status, total seconds and the seconds spent in each phase.
+    """
+    timings = {'status': 'ok'}
+    start = time.time()
+    session = get_session()
+    try:
+        mm(exchange, callback, session, timings=timings)
+    except Exception as e:
+        timings['status'] = 'error: %s' % e
+        session.rollback()
+    finally:
+        get_scoped_session().remove()
+    timings['total'] = time.time() - start
+    return timings
+
+
+def run_mm(exchanges, callback=fib_fan, workers=MM_WORKERS, deadline=MM_DEADLINE, running=None):
+    """
+    Run mm for many exchanges at once, so one slow exchange doesn't hold up the others.
+    Exchanges still running at the deadline are reported as timed out, and left to finish in the background.
+    The pool's threads are daemons, so a caller about to exit should wait for them with wait_for_stragglers.
+
+    :param dict running: If given, the AsyncResults of timed out exchanges are added to it, by exchange. (optional)
+    :return: A dict of exchange -> the timings from run_exchange.
+    :rtype: dict
+    """
+    exchanges = list(exchanges)
+    if len(exchanges) == 0:
+        return {}
+    pool = ThreadPool(min(workers, len(exchanges)))
+    results = dict((exchange, pool.apply_async(run_exchange, (exchange, callback))) for exchange in exchanges)
+    pool.close()
+    end = time.time() + deadline
+    timings = {}
+    for exchange in exchanges:
+        try:
+            timings[exchange] = results[exchange].get(timeout=max(end - time.time(), 0))
+        except TimeoutError:
+            timings[exchange] = {'status': 'timeout', 'total': deadline}
+            if running is not None:
+                running[exchange] = results[exchange]
+    return timings
+
+
+def wait_for_stragglers(running, cap=MM_STRAGGLER_CAP):
+    """
+    Wait for exchanges that timed out in run_mm to finish, so their cycles aren't cut off between
+    the cancels and the creates when the process exits.
+
+    :param dict running: The running dict filled in by run_mm.
+    :param float cap: The most seconds to wait in all.
+    :return: A dict of exchange -> the timings from run_exchange, for the exchanges that finished.
+    :rtype: dict
+    """
+    end = time.time() + cap
+    timings = {}
+    for exchange, result in running.items():
+        try:
+            timings[exchange] = result.get(timeout=max(end - time.time(), 0))
+        except TimeoutError:
+            print "%s still running after %.0fs more, exiting anyway" % (exchange, cap)
+    return timings
+
+
+def print_timings(timings):
+    for exchange in sorted(timings):
+        timing = timings[exchange]
+        phases = ", ".join("%s %.3fs" % (phase, timing[phase]) for phase in ('balances', 'prices', 'orders')
+                           if phase in timing)
+        print "%s: %s in %.3fs (%s)" % (exchange, timing['status'], timing['total'], phases)
+
+
+class MMScheduler(object):
+    """
+    Run mm cycles from a long running process, only for exchanges where something material changed:
+    a ticker index moved more than the threshold, the available balances changed, or the interval elapsed.
+    Connections and in process caches stay warm between cycles.
+    An exchange whose cycle overran the deadline is skipped until that cycle finishes.
+    An exchange whose cycle failed is retried after an exponential backoff, from poll up to interval seconds.
+    Tickers are followed with a TickerSubscriber, so a ticker update wakes the scheduler, at most once per poll.
+    Without ticker updates, exchanges are still checked every idle seconds.
+    """
 
-    for exch in get_running_workers(EXCHANGES, red=red):
-        mm(exch, fib_fan, ses)
+    def __init__(self, callback=fib_fan, interval=300.0, poll=5.0, threshold=0.005, settle=BALANCE_SETTLE,
+                 idle=30.0):
+        """
+        :param float interval: The most seconds between cycles for an exchange.
+        :param float poll: The fewest seconds between checks for changes.
+        :param float threshold: The relative ticker index move that triggers a cycle.
+        :param float settle: The seconds after a cycle during which balance changes don't trigger another.
+        :param float idle: The most seconds between checks when no ticker updates arrive.
+        """
+        self.callback = callback
+        self.interval = interval
+        self.poll = poll
+        self.threshold = threshold
+        self.settle = settle
+        self.idle = idle
+        # exchange -> (time, {market: index}, {commodity: available}) as of the last cycle
+        self.last = {}
+        # exchange -> the AsyncResult of a cycle still running past its deadline
+        self.running = {}
+        # exchange -> (time.time() of the next allowed attempt, consecutive failures) after a failed cycle
+        self.backoff = {}
+        self.subscriber = None
+        self.wake = threading.Event()
+
+    def observe(self, exchange, session):
+        """
+        :return: The current ticker indexes and available balances of an exchange.
+        """
+        markets = get_active_markets(exchange)
+        if self.subscriber is not None and self.subscriber.is_alive():
+            tickers = dict((market, self.subscriber.get_ticker(exchange, market)) for market in markets)
+        else:
+            tickers = dict((market, ticker) for (ex, market), ticker in
+                           get_tickers([(exchange, market) for market in markets]).items())
+        prices = {}
+        for market, ticker in tickers.items():
+            if ticker is not None:
+                prices[market] = ticker.calculate_index().to_double()
+        bals = get_balances(exchange, session=session)
+        session.rollback()
+        balances = dict((str(amount.commodity), amount.to_double()) for amount in bals[1]) if bals else {}
+        return prices, balances
+
+    def reason(self, exchange, prices, balances):
+        """
+        :return: Why the exchange is due for a cycle, or None if it is not.
+        """
+        if exchange not in self.last:
+            return 'start'
+        when, lprices, lbalances = self.last[exchange]
+        if time.time() - when >= self.interval:
+            return 'interval'
+        if balances != lbalances and time.time() - when >= self.settle:
+            return 'balance'
+        for market, index in prices.items():
+            last = lprices.get(market)
+            if last is None or abs(index - last) > self.threshold * last:
+                return 'ticker %s' % market
+        return None
+
+    def finish(self, exchange, timing, session):
+        """
+        Record the outcome of a cycle. A successful one becomes the exchange's baseline,
+        a failed one delays the next attempt.
+        """
+        if timing['status'] == 'ok':
+            self.backoff.pop(exchange, None)
+            # observe again, so the cycle's own orders don't trigger the next one
+            self.last[exchange] = (time.time(),) + self.observe(exchange, session)
+        elif timing['status'] != 'timeout':
+            failures = self.backoff.get(exchange, (0.0, 0))[1] + 1
+            delay = min(self.poll * 2 ** failures, self.interval)
+            self.backoff[exchange] = (time.time() + delay, failures)
+            print "%s cycle failed %s times in a row, retrying in %.0fs" % (exchange, failures, delay)
+
+    def run_once(self):
+        """
+        Check every running exchange, and run a cycle for those that are due.
+
+        :return: The run_mm timings of the exchanges that ran.
+        """
+        session = get_session()
+        finished = {}
+        for exchange, result in self.running.items():
+            if result.ready():
+                del self.running[exchange]
+                finished[exchange] = result.get()
+                print "%s overrun cycle finished: %s" % (exchange, finished[exchange]['status'])
+                self.finish(exchange, finished[exchange], session)
+        due = {}
+        for exchange in get_running_workers(EXCHANGES, red=get_redis()):
+            if exchange in self.running or exchange in finished:
+                continue
+            if time.time() < self.backoff.get(exchange, (0.0, 0))[0]:
+                continue
+            prices, balances = self.observe(exchange, session)
+            reason = self.reason(exchange, prices, balances)
+            if reason is not None:
+                print "%s due: %s" % (exchange, reason)
+                due[exchange] = reason
+            elif time.time() - self.last[exchange][0] < self.settle:
+                # the last cycle's orders are still being created and synced, so follow their balances
+                self.last[exchange] = self.last[exchange][:2] + (balances,)
+        if len(due) == 0:
+            return finished
+        timings = run_mm(due.keys(), self.callback, running=self.running)
+        for exchange in due:
+            self.finish(exchange, timings[exchange], session)
+        timings.update(finished)
+        return timings
+
+    def run_forever(self):
+        self.subscriber = TickerSubscriber(exchanges=EXCHANGES).start()
+        self.subscriber.add_callback(lambda exchange, market, ticker: self.wake.set())
+        try:
+            while True:
+                start = time.time()
+                self.wake.clear()
+                timings = self.run_once()
+                if len(timings) > 0:
+                    print_timings(timings)
+                # updates arriving during this run or the poll after it are coalesced into one wakeup
+                time.sleep(max(self.poll - (time.time() - start), 0))
+                self.wake.wait(max(self.idle - (time.time() - start), 0))
+        finally:
+            self.subscriber.stop()
+            self.subscriber = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Make markets on all running exchanges.')
+    parser.add_argument('--daemon', action='store_true', help='Keep running, and run a cycle when needed.')
+    parser.add_argument('--interval', type=float, default=300.0,
+                        help='The most seconds between cycles in daemon mode.')
+    parser.add_argument('--poll', type=float, default=5.0, help='The fewest seconds between checks in daemon mode.')
+    parser.add_argument('--idle', type=float, default=30.0,
+                        help='The most seconds between checks without ticker updates in daemon mode.')
+    parser.add_argument('--threshold', type=float, default=0.005,
+                        help='The relative ticker move that triggers a cycle in daemon mode.')
+    parser.add_argument('--settle', type=float, default=BALANCE_SETTLE,
+                        help='The seconds after a cycle that balance changes are ignored in daemon mode.')
+    args = parser.parse_args(argv)
+    if args.daemon:
+        MMScheduler(interval=args.interval, poll=args.poll, threshold=args.threshold, settle=args.settle,
+                    idle=args.idle).run_forever()
+    else:
+        running = {}
+        print_timings(run_mm(get_running_workers(EXCHANGES, red=get_redis()), running=running))
+        if len(running) > 0:
+            print_timings(wait_for_stragglers(running))
+
+
+if __name__ == "__main__":
+    main()
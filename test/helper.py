@@ -6,7 +6,7 @@ import time
 from ledger import Amount
 from ledger import Balance
 
-from sqlalchemy_models import jsonify2, create_session_engine, setup_database
+from sqlalchemy_models import create_session_engine, setup_database
 from sqlalchemy_models.util import filter_query_by_attr
 from tappmq.tappmq import get_status
 
@@ -184,8 +184,7 @@ class TestPlugin(ExchangePluginBase):
         """
         tick = em.Ticker(99, 101, 110, 90, 1000,
                          100, market, 'helper')
-        jtick = jsonify2(tick, 'Ticker')
-        self.red.set('%s_%s_ticker' % (self.NAME.lower(), market), jtick)
+        self.save_ticker(tick)
 
     def sync_trades(self, rescan=False):
         """
@@ -1,20 +1,83 @@
+import subprocess
+import sys
 import time
 import unittest
 
-from helper import TestPlugin, start_test_man, stop_test_man
-from sqlalchemy_models import get_schemas
+from helper import TestPlugin, make_base_id, start_test_man, stop_test_man
+from sqlalchemy_models import get_schemas, exchange as em
+from trade_manager import session_scope
 from test.helper import check_test_ticker
-from trade_manager.cli import handle_command
+from trade_manager.cli import handle_command, run_commands
 from trade_manager.plugin import get_orders, get_trades, sync_ticker, sync_balances, get_active_markets, \
     get_preferred_exchange, set_preferred_exchange, get_commodity_config
 
 SCHEMAS = get_schemas()
+# seconds a tradem invocation that does not need the database may take, beyond a bare python startup
+TRADEM_STARTUP_BUDGET = 2.0
 
 tp = TestPlugin()
 tp.setup_connections()
 tp.setup_logger()
 
 
+def test_startup_is_lazy():
+    tp.sync_ticker('BTC_USD')
+    code = "import sys\n" \
+           "import trade_manager\n" \
+           "from trade_manager.cli import handle_command\n" \
+           "handle_command(['ticker', 'get', '-e', 'helper', '-m', 'BTC_USD'])\n" \
+           "assert trade_manager._engine is None\n" \
+           "assert trade_manager._scoped_session is None\n" \
+           "assert 'psycopg2' not in sys.modules\n"
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def best_run_time(code, runs=3):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code])
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def test_startup_budget():
+    tp.sync_ticker('BTC_USD')
+    baseline = best_run_time("pass")
+    elapsed = best_run_time("from trade_manager.cli import handle_command\n"
+                            "handle_command(['ticker', 'get', '-e', 'helper', '-m', 'BTC_USD'])\n")
+    assert elapsed - baseline < TRADEM_STARTUP_BUDGET, (elapsed, baseline)
+
+
+def test_run_commands():
+    lines = ['commodity set AUD 1.01 0.01 0.1 0.25', '', '# a comment', 'commodity get AUD 1 0 0 0', 'nonsense']
+    results = list(run_commands(lines, session=tp.session))
+    assert len(results) == 3
+    assert results[0][0] == 'commodity set AUD 1.01 0.01 0.1 0.25'
+    assert results[1][1]['weight'] == '1.01'
+    assert results[2][1] is None
+    for line, result, elapsed in results:
+        assert elapsed >= 0
+
+
+def test_run_commands_read_fresh_rows():
+    order = em.LimitOrder(100, 0.1, 'BTC_USD', 'bid', 'helper', order_id=make_base_id(l=10), state='open')
+    tp.session.add(order)
+    tp.session.commit()
+    oid = order.id
+    results = run_commands(['order get --oid %s' % oid] * 2, session=tp.session)
+    line, orders, elapsed = next(results)
+    assert orders[0].state == 'open'
+    # the exchange worker closes the order from its own session
+    with session_scope() as other:
+        other.query(em.LimitOrder).filter(em.LimitOrder.id == oid).update({'state': 'closed'})
+        other.commit()
+    line, orders, elapsed = next(results)
+    assert orders[0].state == 'closed'
+    list(results)
+
+
 class TestCLI(unittest.TestCase):
     def setUp(self):
         start_test_man()
@@ -138,3 +201,5 @@ class TestCLI(unittest.TestCase):
         assert conf['floor'] == cfloor
         assert conf['target'] == ctarget
         assert conf['ceil'] == cceil
+        confs = handle_command(['commodity', 'get'], session=tp.session)
+        assert confs['AUD'] == conf
@@ -0,0 +1,153 @@
+"""
+Query plan regression tests. Seed a synthetic dataset large enough for the planner to prefer indexes,
+then assert via EXPLAIN that each hot lookup uses one. Plans are taken from the queries the helpers
+actually run: keyset pages, ledger streams and the grouped balance sums.
+"""
+import datetime
+import random
+
+from helper import TestPlugin, make_base_id
+from sqlalchemy_models import exchange as em, user as um, wallet as wm
+from trade_manager import INDEXES, ensure_indexes, get_engine, _create_index
+from trade_manager.plugin import order_query, trade_query, keyset_page, ledger_query, balance_query, PAGE_SIZE, \
+    _keyset_columns
+
+# rows of each type to seed
+SEED_SIZE = 20000
+EXCHANGES = ['ix%s' % i for i in range(20)]
+MARKETS = ['M%s_BTC' % i for i in range(20)]
+STATES = ['pending', 'open', 'closed']
+
+tp = TestPlugin()
+tp.setup_connections()
+tp.setup_logger()
+# seeded balances, credits and debits belong to this user, never to a manager user other tests rely on.
+# It is named like a manager user, so get_balances can find it by exchange.
+INDEX_EXCHANGE = 'indextest'
+INDEX_USER = '%sManager' % INDEX_EXCHANGE
+index_user = None
+
+
+def random_currency():
+    return ''.join(random.choice('QWXZ') for _ in range(4))
+
+
+def cleanup():
+    """
+    Remove all seeded rows, including any left by an aborted run.
+    """
+    tp.session.rollback()
+    tp.session.query(em.Trade).filter(em.Trade.exchange.in_(EXCHANGES)).delete(synchronize_session=False)
+    tp.session.query(em.LimitOrder).filter(em.LimitOrder.exchange.in_(EXCHANGES)).delete(synchronize_session=False)
+    user = tp.session.query(um.User).filter(um.User.username == INDEX_USER).one_or_none()
+    if user is not None:
+        for model in (wm.Balance, wm.Credit, wm.Debit):
+            tp.session.query(model).filter(model.user_id == user.id).delete(synchronize_session=False)
+        tp.session.delete(user)
+    tp.session.commit()
+
+
+def seed():
+    global index_user
+    index_user = um.User(username=INDEX_USER)
+    tp.session.add(index_user)
+    tp.session.commit()
+    start = datetime.datetime(2016, 1, 1)
+    trades, orders, balances, credits, debits = [], [], [], [], []
+    for i in range(SEED_SIZE):
+        exchange = random.choice(EXCHANGES)
+        market = random.choice(MARKETS)
+        when = start + datetime.timedelta(minutes=i)
+        trades.append(em.Trade(make_base_id(l=12), exchange, market, 'buy', 0.1, 100, 0, 'quote', when))
+        orders.append(em.LimitOrder(100, 0.1, market, 'bid', exchange, make_base_id(l=12), when, when, 0,
+                                    random.choice(STATES)))
+        balances.append(wm.Balance(1, 1, random_currency(), exchange, index_user.id, time=when))
+        credits.append(wm.Credit(1, make_base_id(10), 'BTC', 'helper', 'complete', exchange, make_base_id(12),
+                                 index_user.id, time=when))
+        debits.append(wm.Debit(1, 0, make_base_id(10), 'BTC', 'helper', 'complete', exchange, make_base_id(12),
+                               index_user.id, time=when))
+    for rows in (trades, orders, balances, credits, debits):
+        tp.session.bulk_save_objects(rows)
+    tp.session.commit()
+    for table in ('trade', 'limit_order', 'balance', 'credit', 'debit'):
+        tp.session.execute("ANALYZE %s" % table)
+    tp.session.commit()
+
+
+def setup_module(module):
+    cleanup()
+    try:
+        seed()
+    except Exception:
+        cleanup()
+        raise
+
+
+def teardown_module(module):
+    cleanup()
+
+
+def explain(query):
+    # bound, not literal, parameters, since keyset pages compare against datetimes
+    compiled = query.statement.compile(dialect=tp.session.bind.dialect)
+    plan = "\n".join(row[0] for row in tp.session.connection().execute("EXPLAIN %s" % compiled, compiled.params))
+    tp.session.rollback()
+    return plan
+
+
+def assert_index_scan(query):
+    plan = explain(query)
+    assert 'Index' in plan, plan
+    assert 'Seq Scan' not in plan, plan
+
+
+def pages(query, model, timecol):
+    """
+    The first and a later keyset page of a query, ordered by id and by time, as the iter_* helpers page it.
+    """
+    first = query.order_by(model.id).first()
+    for order_by in ('id', 'time'):
+        columns = _keyset_columns(model, timecol, order_by)
+        yield keyset_page(query, columns, PAGE_SIZE)
+        yield keyset_page(query, columns, PAGE_SIZE, last=[getattr(first, column.key) for column in columns])
+
+
+def test_order_by_order_id():
+    order = tp.session.query(em.LimitOrder).filter(em.LimitOrder.exchange == 'ix1').first()
+    for query in (order_query(tp.session, order_id=order.order_id), order_query(tp.session, oid=order.id)):
+        assert_index_scan(keyset_page(query, _keyset_columns(em.LimitOrder, em.LimitOrder.create_time, 'id'),
+                                      PAGE_SIZE))
+
+
+def test_order_by_exchange_state_market():
+    query = order_query(tp.session, exchange='ix1', state='open', market='M1_BTC')
+    for page in pages(query, em.LimitOrder, em.LimitOrder.create_time):
+        assert_index_scan(page)
+
+
+def test_trade_by_trade_id():
+    trade = tp.session.query(em.Trade).filter(em.Trade.exchange == 'ix1').first()
+    assert_index_scan(keyset_page(trade_query(tp.session, trade_id=trade.trade_id),
+                                  _keyset_columns(em.Trade, em.Trade.time, 'id'), PAGE_SIZE))
+
+
+def test_trade_by_exchange_market():
+    for page in pages(trade_query(tp.session, exchange='ix1', market='M1_BTC'), em.Trade, em.Trade.time):
+        assert_index_scan(page)
+
+
+def test_balance_by_user_currency():
+    assert_index_scan(balance_query(tp.session, exchange=INDEX_EXCHANGE, currency='QWXZ'))
+
+
+def test_ledger_by_reference():
+    after = (datetime.datetime(2016, 1, 5), 'd', 0)
+    for kind in ('c', 'd', 't'):
+        assert_index_scan(ledger_query(tp.session, kind, exchange='ix1'))
+        assert_index_scan(ledger_query(tp.session, kind, exchange='ix1', after=after))
+
+
+def test_ensure_indexes_is_idempotent():
+    assert ensure_indexes() == []
+    # a worker that lost the race to create an index carries on
+    _create_index(get_engine(), INDEXES[0])
@@ -10,7 +10,8 @@ from tappmq.tappmq import get_status
 from test.helper import stop_test_man, start_test_man, TestPlugin, check_test_ticker
 from test.test_plugin import check_test_ticker
 from trade_manager.plugin import get_balances, create_order, submit_order, get_orders, get_credits, sync_credits, \
-    get_debits, sync_debits, get_trades, sync_trades, sync_ticker, get_ticker, cancel_orders
+    get_debits, sync_debits, get_trades, sync_trades, sync_ticker, get_ticker, cancel_orders, create_orders, \
+    submit_orders
 from trade_manager.plugin import sync_balances
 
 
@@ -54,6 +55,22 @@ class TestPluginRunning(TestCase):
         for amount in total:
             assert amount >= available.commodity_amount(amount.commodity)
 
+    def test_create_orders(self):
+        orders = create_orders('helper', [(100, 0.1, 'BTC_USD', 'bid'), (101, 0.1, 'BTC_USD', 'bid')],
+                               session=tp.session, submit=False)
+        oids = [order.id for order in orders]
+        tp.session.close()
+        submit_orders('helper', oids)
+        countdown = 30
+        oorders = [get_orders(oid=oid, session=tp.session)[0] for oid in oids]
+        while any(order.state == 'pending' for order in oorders) and countdown > 0:
+            countdown -= 1
+            time.sleep(0.01)
+            tp.session.close()
+            oorders = [get_orders(oid=oid, session=tp.session)[0] for oid in oids]
+        assert len(oorders) == 2
+        assert all(order.state == 'open' for order in oorders)
+
     def test_cancel_order_order_id(self):
         order = create_order('helper', 100, 0.1, 'BTC_USD', 'bid', session=tp.session, submit=False)
         assert isinstance(order.id, int)
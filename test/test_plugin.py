@@ -1,12 +1,25 @@
+import datetime
+import os
+import random
+import tempfile
+import threading
 import time
 from ledger import Amount, Balance
 
 from alchemyjsonschema.dictify import datetime_rfc3339
 
 from helper import TestPlugin, make_base_id
-from sqlalchemy_models import get_schemas, exchange as em, wallet as wm
+from sqlalchemy_models import get_schemas, jsonify2, exchange as em, wallet as wm
 from test.helper import check_test_ticker
-from trade_manager.plugin import get_ticker, get_balances, get_orders, get_trades, make_ledger, get_debits, get_credits
+from trade_manager.plugin import get_ticker, get_tickers, get_balances, get_orders, get_trades, make_ledger, \
+    get_debits, get_credits, get_preferred_exchange, set_preferred_exchange, invalidate_routing, get_active_markets, \
+    add_active_markets, rem_active_markets, write_ledger, update_ledger_file, verify_ledger_file, iter_ledger, \
+    iter_trades, get_market_vol_shares, get_all_market_vol_shares, get_commodity_config, get_commodity_configs, \
+    set_commodity_config, get_rate, get_usd_value, PriceSnapshot, create_orders, reconcile_ladder, TickerSubscriber, \
+    set_active_markets, publish_ticker, get_exchange_markets
+from trade_manager.codec import encode_ticker, decode_ticker
+from trade_manager.pricegraph import PriceGraph
+from trade_manager.reconcile import reconcile_orders, locked_amounts
 
 tp = TestPlugin()
 tp.setup_connections()
@@ -20,6 +33,212 @@ def test_ticker():
     check_test_ticker(ticker)
 
 
+def test_ticker_subscriber():
+    tp.sync_ticker('BTC_USD')
+    subscriber = TickerSubscriber(exchanges=['helper']).start()
+    try:
+        # warmed from the current ticker keys
+        check_test_ticker(subscriber.get_ticker('helper', 'BTC_USD'))
+        received = threading.Event()
+        subscriber.add_callback(lambda exchange, market, ticker: market == 'DASH_BTC' and received.set())
+        tp.sync_ticker('DASH_BTC')
+        assert received.wait(1.0)
+        check_test_ticker(subscriber.get_ticker('helper', 'DASH_BTC'), market='DASH_BTC')
+        assert subscriber.is_alive()
+        assert subscriber.last_message is not None
+        # a malformed payload or a failing callback doesn't stop the listener
+        received.clear()
+        subscriber.add_callback(lambda exchange, market, ticker: 1 / 0)
+        tp.red.publish('ticker:helper:DASH_BTC', 'not a ticker')
+        tp.sync_ticker('DASH_BTC')
+        assert received.wait(1.0)
+        assert subscriber.is_alive()
+    finally:
+        subscriber.stop()
+    assert not subscriber.is_alive()
+
+
+def test_ticker_codec():
+    ticker = em.Ticker(0.00123456, 0.00123789, 0.0013, 0.0012, 123456.789, 0.00123555, 'DASH_BTC', 'helper')
+    jtick = encode_ticker(ticker)
+    btick = encode_ticker(ticker, binary=True)
+    assert len(btick) < len(jtick)
+    for raw in (jtick, btick):
+        decoded = decode_ticker(raw)
+        check_test_ticker(decoded, market='DASH_BTC')
+        for attr in ('bid', 'ask', 'high', 'low', 'volume', 'last'):
+            assert getattr(decoded, attr) == getattr(ticker, attr)
+        assert decoded.exchange == 'helper'
+        assert abs((decoded.time - ticker.time).total_seconds()) < 1
+    # amounts too large for an int64 of satoshis, or finer than a satoshi, fall back to JSON
+    for ticker in (em.Ticker(100, 101, 102, 99, 1e12, 100, 'BTC_USD', 'helper'),
+                   em.Ticker(1e-9, 2e-9, 3e-9, 1e-9, 1000, 2e-9, 'SHIB_BTC', 'helper')):
+        raw = encode_ticker(ticker, binary=True)
+        assert not raw.startswith(b'TK')
+        decoded = decode_ticker(raw)
+        for attr in ('bid', 'ask', 'high', 'low', 'volume', 'last'):
+            assert getattr(decoded, attr) == getattr(ticker, attr)
+
+    tp.BINARY_TICKERS = True
+    try:
+        tp.sync_ticker('BTC_USD')
+        assert tp.red.get('helper_BTC_USD_ticker').startswith(b'TK')
+        check_test_ticker(get_ticker('helper', market='BTC_USD'))
+    finally:
+        tp.BINARY_TICKERS = False
+        tp.sync_ticker('BTC_USD')
+
+
+def test_tickers():
+    tp.sync_ticker('BTC_USD')
+    tp.sync_ticker('DASH_BTC')
+    tickers = get_tickers([('helper', 'BTC_USD'), ('helper', 'DASH_BTC'), ('helper', 'NOPE_BTC')])
+    assert len(tickers) == 3
+    check_test_ticker(tickers[('helper', 'BTC_USD')])
+    check_test_ticker(tickers[('helper', 'DASH_BTC')], market='DASH_BTC')
+    assert tickers[('helper', 'NOPE_BTC')] is None
+
+
+def test_all_market_vol_shares():
+    # XYZ_BTC has no ticker, so it can't be priced
+    set_active_markets('volshare', ['BTC_USD', 'BTC_EUR', 'DASH_USD', 'XYZ_BTC'])
+    tp.red.delete('volshare_XYZ_BTC_ticker')
+    publish_ticker(em.Ticker(100, 100, 100, 100, 10, 100, 'BTC_USD', 'volshare'))
+    publish_ticker(em.Ticker(90, 90, 90, 90, 5, 90, 'BTC_EUR', 'volshare'))
+    publish_ticker(em.Ticker(10, 10, 10, 10, 20, 10, 'DASH_USD', 'volshare'))
+    set_preferred_exchange('BTC_USD', 'volshare')
+    configs = get_commodity_configs(['BTC', 'EUR', 'USD', 'DASH'])
+    weight = dict((comm, configs[comm]['weight']) for comm in configs)
+    # BTC_EUR is valued at the BTC_USD index
+    btc_usd = weight['BTC'] * weight['USD'] * 10 * 100
+    btc_eur = weight['BTC'] * weight['EUR'] * 5 * 100
+    dash_usd = weight['DASH'] * weight['USD'] * 20 * 10
+    allshares = get_all_market_vol_shares('volshare')
+    assert set(allshares) == {'BTC', 'EUR', 'USD', 'DASH'}
+    assert set(allshares['BTC']) == {'total', 'BTC_USD', 'BTC_EUR'}
+    assert abs(allshares['BTC']['total'].to_double() - (btc_usd + btc_eur)) < 1e-6
+    assert abs(allshares['BTC']['BTC_USD']['vol_share'] - btc_usd / (btc_usd + btc_eur)) < 1e-9
+    assert abs(allshares['BTC']['BTC_EUR']['vol_share'] - btc_eur / (btc_usd + btc_eur)) < 1e-9
+    assert abs(allshares['USD']['total'].to_double() - (btc_usd + dash_usd)) < 1e-6
+    assert abs(allshares['USD']['DASH_USD']['vol_share'] - dash_usd / (btc_usd + dash_usd)) < 1e-9
+    assert abs(allshares['USD']['DASH_USD']['USD_volume'].to_double() - dash_usd) < 1e-6
+    assert allshares['EUR']['BTC_EUR']['vol_share'] == 1
+    assert set(get_market_vol_shares('volshare', 'DASH')) == {'total', 'DASH_USD'}
+    set_preferred_exchange('BTC_USD', 'helper')
+    set_active_markets('volshare', [])
+
+
+def test_commodity_configs():
+    import trade_manager.plugin
+    tp.red.set('LGCY_config', '{"weight": 2.0}')
+    tp.red.set('BADC_config', 'not json')
+    tp.red.set('UNKN_config', '{"weight": 4.0}')
+    tp.red.set('helper_worker_config', '{"queue": "helper"}')
+    tp.red.delete('commodity_config_migrated')
+    trade_manager.plugin._migrate_commodity_configs(tp.red)
+    # any commodity is migrated, whether or not it is in an active market
+    assert tp.red.get('LGCY_config') is None
+    assert tp.red.get('UNKN_config') is None
+    # values that aren't JSON configs, and keys not named like a commodity, are left alone
+    assert tp.red.get('BADC_config') == 'not json'
+    assert tp.red.get('helper_worker_config') == '{"queue": "helper"}'
+    # it only runs once
+    tp.red.set('LGCY_config', '{"weight": 5.0}')
+    trade_manager.plugin._migrate_commodity_configs(tp.red)
+    assert tp.red.get('LGCY_config') == '{"weight": 5.0}'
+    tp.red.delete('LGCY_config', 'BADC_config', 'helper_worker_config')
+    tp.red.hdel('commodity_config', 'UNKN')
+    tp.red.hset('commodity_config', 'BADJ', 'not json')
+    set_commodity_config('CFGA', weight=1.5)
+    configs = get_commodity_configs(['LGCY', 'CFGA', 'NOPE', 'BADJ'])
+    assert configs['LGCY']['weight'] == 2.0
+    assert configs['CFGA']['weight'] == 1.5
+    assert configs['NOPE'] == {'weight': 1.0, 'floor': 0.0, 'target': 0.0, 'ceil': 0.0}
+    assert configs['BADJ'] == configs['NOPE']
+    assert 'LGCY' in get_commodity_configs()
+    tp.red.hdel('commodity_config', 'BADJ')
+    # writes that bypass set_commodity_config are not seen until the cache expires
+    tp.red.hset('commodity_config', 'CFGA', '{"weight": 3.0}')
+    assert get_commodity_config('CFGA')['weight'] == 1.5
+    trade_manager.plugin.invalidate_commodity_configs()
+    assert get_commodity_config('CFGA')['weight'] == 3.0
+    tp.red.hdel('commodity_config', 'LGCY', 'CFGA')
+    trade_manager.plugin.invalidate_commodity_configs()
+
+
+def test_price_graph():
+    graph = PriceGraph([em.Ticker(99, 101, 110, 90, 10, 100, 'BTC_USD', 'helper'),
+                        em.Ticker(0.02, 0.021, 0.03, 0.01, 100, 0.0205, 'ETH_BTC', 'helper'),
+                        em.Ticker(0.1, 0.11, 0.2, 0.05, 1000, 0.105, 'LSK_ETH', 'helper'),
+                        em.Ticker(0.001, 0.0015, 0.002, 0.001, 1, 0.00125, 'LSK_BTC', 'helper')])
+    # the wide LSK_BTC spread costs more than the extra hop through ETH
+    assert [t.market for t in graph.get_path('LSK', 'USD')] == ['LSK_ETH', 'ETH_BTC', 'BTC_USD']
+    rate = graph.get_rate('LSK', 'USD')
+    assert abs(rate - 0.105 * 0.0205 * 100) < 1e-9
+    assert abs(graph.get_rate('USD', 'LSK') * rate - 1) < 1e-9
+    assert graph.get_rate('NOPE', 'USD') is None
+    assert graph.get_rate('BTC', 'BTC') == 1.0
+
+
+def test_get_rate():
+    tp.sync_ticker('BTC_USD')
+    tp.sync_ticker('DASH_BTC')
+    assert get_rate('BTC', 'USD', exchanges=['helper']) == Amount("100 USD")
+    assert get_rate('DASH', 'USD', exchanges=['helper']) == Amount("10000 USD")
+    assert get_rate('NOPE', 'USD', exchanges=['helper']) is None
+
+
+def test_exchange_markets_skip_unconfigured():
+    pairs = get_exchange_markets(['helper', 'unconfigured'])
+    assert len(pairs) > 0
+    assert set(exchange for exchange, market in pairs) == {'helper'}
+    tp.sync_ticker('BTC_USD')
+    assert get_rate('BTC', 'USD', exchanges=['helper', 'unconfigured']) == Amount("100 USD")
+
+
+def test_price_snapshot():
+    tp.sync_ticker('BTC_USD')
+    tp.sync_ticker('DASH_BTC')
+    set_preferred_exchange('BTC_USD', 'helper')
+    set_preferred_exchange('DASH_BTC', 'helper')
+    snapshot = PriceSnapshot(commodities=['BTC', 'DASH'], exchanges=['helper', 'unconfigured'])
+    # later ticks are not seen by the snapshot
+    tp.red.set('helper_BTC_USD_ticker', jsonify2(em.Ticker(199, 201, 210, 190, 1000, 200, 'BTC_USD', 'helper'),
+                                                 'Ticker'))
+    assert snapshot.get_usd_price('BTC') == Amount("100 USD")
+    assert get_usd_value(Amount("2 BTC"), snapshot=snapshot) == Amount("200 USD")
+    assert get_usd_value(Amount("1 DASH"), snapshot=snapshot) == Amount("10000 USD")
+    assert get_usd_value(Amount("2 BTC")) == Amount("400 USD")
+    assert snapshot.get_usd_price('NOPE') is None
+    shares = get_all_market_vol_shares('helper', snapshot=snapshot)
+    assert shares['BTC']['BTC_USD']['ticker'] is snapshot.get_ticker('helper', 'BTC_USD')
+    tp.sync_ticker('BTC_USD')
+
+
+def test_preferred_exchange_routing():
+    set_preferred_exchange('ETH_AUD', 'helper')
+    assert get_preferred_exchange('ETH_AUD') == 'helper'
+    # changes that bypass the routing version are not seen until it is invalidated
+    tp.red.set('ETH_AUD_preferred_exchange', 'kraken')
+    assert get_preferred_exchange('ETH_AUD') == 'helper'
+    invalidate_routing()
+    assert get_preferred_exchange('ETH_AUD') == 'kraken'
+    set_preferred_exchange('ETH_AUD', None)
+    assert get_preferred_exchange('ETH_AUD') is None
+
+
+def test_active_markets_migration():
+    tp.red.delete('legacy_active_market_set')
+    tp.red.set('legacy_active_markets', '["BTC_USD", "DASH_BTC"]')
+    assert get_active_markets('legacy') == ['BTC_USD', 'DASH_BTC']
+    assert tp.red.get('legacy_active_markets') is None
+    add_active_markets('legacy', ['ETH_BTC', 'BTC_USD'])
+    assert get_active_markets('legacy') == ['BTC_USD', 'DASH_BTC', 'ETH_BTC']
+    rem_active_markets('legacy', ['BTC_USD', 'LTC_BTC'])
+    assert get_active_markets('legacy') == ['DASH_BTC', 'ETH_BTC']
+    tp.red.delete('legacy_active_market_set')
+
+
 def test_balance():
     tp.sync_balances()
     total, available = get_balances('helper', session=tp.session)
@@ -29,6 +248,16 @@ def test_balance():
         assert amount >= available.commodity_amount(amount.commodity)
 
 
+def test_balance_by_exchange():
+    tp.sync_balances()
+    total, available, breakdown = get_balances(session=tp.session, by_exchange=True)
+    assert 'helper' in breakdown
+    htotal, havailable = get_balances('helper', session=tp.session)
+    assert str(breakdown['helper'][0]) == str(htotal)
+    assert str(breakdown['helper'][1]) == str(havailable)
+    assert str(get_balances(session=tp.session)[0]) == str(total)
+
+
 def test_order_lifecycle():
     order = em.LimitOrder(100, 0.1, 'BTC_USD', 'bid', 'helper', order_id=make_base_id(l=10))
     assert isinstance(order.price, Amount)
@@ -45,6 +274,54 @@ def test_order_lifecycle():
     assert torder.state == 'open'
 
 
+def test_create_orders():
+    orders = create_orders('helper', [(100, 0.1, 'BTC_USD', 'bid'),
+                                      {'price': 0.01, 'amount': 1, 'market': 'DASH_BTC', 'side': 'ask'}],
+                           session=tp.session, submit=False)
+    assert len(orders) == 2
+    assert orders[0].price == Amount("100 USD")
+    assert orders[1].price == Amount("0.01 BTC")
+    assert all(order.state == 'pending' for order in orders)
+    created = tp.create_orders([order.id for order in orders])
+    assert [order.id for order in created] == [order.id for order in orders]
+    assert all(order.state == 'open' for order in created)
+    assert create_orders('helper', [], session=tp.session, submit=False) == []
+
+
+def test_reconcile_orders():
+    current = [em.LimitOrder(100, 1, 'BTC_USD', 'ask', 'helper', order_id=make_base_id(l=10)),
+               em.LimitOrder(101, 1, 'BTC_USD', 'ask', 'helper', order_id=make_base_id(l=10)),
+               em.LimitOrder(102, 1, 'BTC_USD', 'ask', 'helper', order_id=make_base_id(l=10)),
+               em.LimitOrder(110, 1, 'BTC_USD', 'ask', 'helper', order_id=make_base_id(l=10))]
+    diff = reconcile_orders([(100.05, 1.01), (101, 2), (102, 1), (105, 1)], current)
+    assert diff['keep'] == [current[0], current[2]]
+    assert diff['amend'] == [(current[1], (101, 2))]
+    assert diff['create'] == [(105, 1)]
+    assert diff['cancel'] == [current[3]]
+    current[0].exec_amount = 0.25
+    current.append(em.LimitOrder(100, 2, 'BTC_USD', 'bid', 'helper', order_id=make_base_id(l=10)))
+    locked = locked_amounts(current)
+    assert abs(locked['BTC'] - 3.75) < 1e-9
+    assert abs(locked['USD'] - 200) < 1e-9
+
+
+def test_reconcile_ladder():
+    market = 'R%s_BTC' % random.randint(100, 999)
+    ladder = [(0.01, 1), (0.011, 1), (0.012, 1)]
+    diff = reconcile_ladder('helper', market, 'ask', ladder, tp.session, submit=False)
+    assert len(diff['keep']) + len(diff['created']) == 3
+    diff = reconcile_ladder('helper', market, 'ask', ladder, tp.session, submit=False)
+    assert len(diff['keep']) == 3
+    assert diff['created'] == []
+    assert diff['cancel'] == []
+    # without the cancels sent, amended levels are not duplicated
+    diff = reconcile_ladder('helper', market, 'ask', [(0.01, 2), (0.011, 1), (0.012, 1)], tp.session, submit=False)
+    assert len(diff['amend']) == 1
+    assert diff['created'] == []
+    assert sum(len(get_orders('helper', market, 'ask', state=state, session=tp.session))
+               for state in ('pending', 'open')) == 3
+
+
 def test_cancel_order_order_id():
     order = em.LimitOrder(100, 0.1, 'BTC_USD', 'bid', 'helper', order_id=make_base_id(l=10))
     tp.session.add(order)
@@ -131,6 +408,38 @@ def test_cancel_orders_by_market():
     assert asks >= 1
 
 
+def test_add_orders():
+    oid1 = make_base_id(l=10)
+    oid2 = make_base_id(l=10)
+    orders = [(100, 0.1, 'BTC_USD', 'bid', oid1, None, None, 0, 'open'),
+              {'price': 101, 'amount': 0.1, 'market': 'BTC_USD', 'side': 'ask', 'order_id': oid2, 'state': 'open'}]
+    changed = tp.add_orders(orders)
+    tp.session.commit()
+    assert len(changed) == 2
+    assert len(get_orders('helper', order_id=oid1, session=tp.session)) == 1
+    assert len(tp.add_orders(orders)) == 0
+    changed = tp.add_orders([(100, 0.1, 'BTC_USD', 'bid', oid1, None, None, 0.05, 'open')])
+    tp.session.commit()
+    assert len(changed) == 1
+    assert changed[0].exec_amount == Amount("0.05 BTC")
+
+
+def test_nonce():
+    start = int(time.time() * 1000)
+    nonce = tp.create_nonce(start)
+    assert nonce >= start
+    assert tp.next_nonce() == nonce + 1
+    assert tp.create_nonce(start) == nonce + 2
+    tp.NONCE_BLOCK_SIZE = 10
+    try:
+        nonces = [tp.next_nonce() for _ in range(15)]
+    finally:
+        tp.NONCE_BLOCK_SIZE = 1
+        tp._nonce_block = None
+    assert nonces == list(range(nonce + 3, nonce + 18))
+    assert tp.next_nonce() == nonce + 23
+
+
 def test_get_trades():
     trade = em.Trade(make_base_id(l=10), 'helper', 'BTC_USD', 'buy', 0.1, 100, 0, 'quote')
     assert isinstance(trade.price, Amount)
@@ -168,6 +477,67 @@ def test_get_trades():
         assert trade.market == 'DASH_BTC'
 
 
+def test_iter_trades():
+    market = 'ITR_%s' % make_base_id(l=6)
+    start = datetime.datetime(2016, 1, 1)
+    for i in range(7):
+        tp.session.add(em.Trade(make_base_id(l=10), 'helper', market, 'buy', 0.1, 100, 0, 'quote',
+                                start + datetime.timedelta(hours=i)))
+    tp.session.commit()
+    trades = list(iter_trades(market=market, session=tp.session))
+    assert len(trades) == 7
+    assert [t.id for t in trades] == sorted(t.id for t in trades)
+
+    import trade_manager.plugin
+    page_size = trade_manager.plugin.PAGE_SIZE
+    trade_manager.plugin.PAGE_SIZE = 2
+    try:
+        assert [t.id for t in iter_trades(market=market, session=tp.session)] == [t.id for t in trades]
+    finally:
+        trade_manager.plugin.PAGE_SIZE = page_size
+
+    assert len(get_trades(market=market, limit=3, session=tp.session)) == 3
+    trades = get_trades(market=market, since=start + datetime.timedelta(hours=2),
+                        until=start + datetime.timedelta(hours=5), order_by='time', session=tp.session)
+    assert [t.time for t in trades] == [start + datetime.timedelta(hours=h) for h in (2, 3, 4)]
+
+
+def test_shared_engine():
+    from trade_manager import get_engine, get_pool_stats
+    eng = get_engine()
+    before = get_pool_stats()
+    market = 'SE%s_BTC' % random.randint(100, 999)
+    for i in range(3):
+        assert len(get_trades(market=market)) == i
+        tp.session.add(em.Trade(make_base_id(l=10), 'helper', market, 'buy', 0.1, 100, 0, 'quote'))
+        tp.session.commit()
+    # helper calls leave no connection checked out, and see rows committed since their last call
+    assert len(get_trades(market=market)) == 3
+    assert get_engine() is eng
+    stats = get_pool_stats()
+    assert stats['checkouts'] > before['checkouts']
+    assert stats['checkedout'] == before['checkedout']
+
+
+def test_add_trades():
+    tid = make_base_id(l=10)
+    trades = [('BTC_USD', tid, 'buy', 100, 0.1, 0, 'quote', None),
+              ('BTC_USD', tid, 'buy', 100, 0.1, 0, 'quote', None),
+              {'market': 'DASH_BTC', 'tid': make_base_id(l=10), 'trade_side': 'sell', 'price': 0.01, 'amount': 1,
+               'fee': 0, 'fee_side': 'quote'}]
+    new, known = tp.add_trades(trades)
+    tp.session.commit()
+    assert new == 2
+    assert known == 1
+    assert len(get_trades('helper', trade_id=tid, session=tp.session)) == 1
+    new, known = tp.add_trades(trades)
+    assert new == 0
+    assert known == 3
+    hits = tp.trade_cache.stats()['hits']
+    assert tp.add_trade('BTC_USD', tid, 'buy', 100, 0.1, 0, 'quote', None) is None
+    assert tp.trade_cache.stats()['hits'] == hits + 1
+
+
 def test_ledger():
     tp.session.query(em.Trade).delete()
     tp.session.query(wm.Credit).delete()
@@ -208,3 +578,24 @@ P {2} USD 0.01000000 BTC
            trade.time.strftime('%Y/%m/%d %H:%M:%S'),
            datetime_rfc3339(trade.time), trade.trade_id)
     assert ledger == hardledger
+    out = tempfile.TemporaryFile('w+')
+    assert write_ledger(out, 'helper', session=tp.session) == 3
+    out.seek(0)
+    assert out.read() == hardledger
+
+
+def test_incremental_ledger():
+    path = os.path.join(tempfile.mkdtemp(), 'helper.ledger')
+    total = len(list(iter_ledger('helper', session=tp.session)))
+    assert update_ledger_file(path, 'helper', session=tp.session) == total
+    assert update_ledger_file(path, 'helper', session=tp.session) == 0
+    tp.sync_credits()
+    tp.sync_trades()
+    assert update_ledger_file(path, 'helper', session=tp.session) == 2
+    assert verify_ledger_file(path, 'helper', session=tp.session)
+    with open(path, 'a') as ledger:
+        ledger.write("garbage")
+    assert not verify_ledger_file(path, 'helper', session=tp.session)
+    # anything after the last checkpoint is discarded on the next update
+    assert update_ledger_file(path, 'helper', session=tp.session) == 0
+    assert verify_ledger_file(path, 'helper', session=tp.session)
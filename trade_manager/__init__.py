@@ -1,12 +1,223 @@
 """
-The main trade_manager module. Initializes sessions, and connections.
+The main trade_manager module. Provides lazily created, per process sessions and connections.
+Nothing connects to the database until it is first needed.
 """
-from sqlalchemy_models import wallet as wm, exchange as em, user as um, create_session_engine, setup_database
-from tapp_config import get_config
+import contextlib
+import os
+import time
 
-CFG = get_config('trade_manager')
-ses, eng = create_session_engine(cfg=CFG)
-setup_database(eng, modules=[wm, em, um])
+from sqlalchemy import event, exc, pool
+from sqlalchemy_models import wallet as wm, exchange as em, user as um, sa, orm, setup_database
+from tapp_config import get_config
 
 NETWORK_COMMODITY_MAP = {'BTC': 'Bitcoin', 'DASH': 'Dash', 'ETH': 'Ethereum', 'LTC': 'Litecoin'}
 EXCHANGES = ['kraken', 'bitfinex', 'poloniex']
+
+# connection pool settings, overridable in the [db] section of the config
+POOL_DEFAULTS = {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600, 'pool_timeout': 30, 'pre_ping': True}
+
+# Composite indexes for the hot lookups in trade_manager.plugin. Trade.trade_id and LimitOrder.order_id are
+# already unique in sqlalchemy_models, so they are indexed there.
+INDEXES = [
+    sa.Index('ix_limit_order_exchange_state_market', em.LimitOrder.exchange, em.LimitOrder.state,
+             em.LimitOrder.market),
+    sa.Index('ix_trade_exchange_market_time', em.Trade.exchange, em.Trade.market, em.Trade.time),
+    sa.Index('ix_trade_exchange_time', em.Trade.exchange, em.Trade.time),
+    sa.Index('ix_balance_user_id_currency', wm.Balance.user_id, wm.Balance.currency),
+    sa.Index('ix_credit_reference_time', wm.Credit.reference, wm.Credit.time),
+    sa.Index('ix_debit_reference_time', wm.Debit.reference, wm.Debit.time),
+]
+
+_cfg = None
+_engine = None
+_sessionmaker = None
+_scoped_session = None
+_session_pid = None
+_schema_ready = False
+_pool_stats = {'checkouts': 0, 'timeouts': 0, 'wait_time': 0.0, 'max_wait': 0.0, 'pings_failed': 0}
+
+
+def get_cfg():
+    """
+    :return: The trade_manager configuration, read on first use.
+    """
+    global _cfg
+    if _cfg is None:
+        _cfg = get_config('trade_manager')
+    return _cfg
+
+
+class TimedQueuePool(pool.QueuePool):
+    """
+    A QueuePool that records how long each checkout waited for a connection.
+    """
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            _pool_stats['timeouts'] += 1
+            raise
+        finally:
+            wait = time.time() - start
+            _pool_stats['checkouts'] += 1
+            _pool_stats['wait_time'] += wait
+            _pool_stats['max_wait'] = max(_pool_stats['max_wait'], wait)
+
+
+def get_pool_options(cfg=None):
+    """
+    :return: The connection pool options, read from the [db] section of the config.
+    """
+    cfg = cfg or get_cfg()
+    options = {}
+    for key, default in POOL_DEFAULTS.items():
+        if not cfg.has_option('db', key):
+            options[key] = default
+        elif isinstance(default, bool):
+            options[key] = cfg.getboolean('db', key)
+        else:
+            options[key] = cfg.getint('db', key)
+    return options
+
+
+def _protect_engine(eng, pre_ping=False):
+    """
+    Make an engine's pool fork safe, by refusing to hand out connections created in another process.
+    If pre_ping is set, also test each connection on checkout, so stale connections are replaced instead of failing.
+    """
+    @event.listens_for(eng, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(eng, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError("Connection record belongs to pid %s, attempting to check out in pid %s" %
+                                         (connection_record.info['pid'], pid))
+        if pre_ping:
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.close()
+            except Exception as e:
+                _pool_stats['pings_failed'] += 1
+                raise exc.DisconnectionError("Connection failed pre-ping: %s" % e)
+
+
+def get_engine():
+    """
+    :return: The process wide sqlalchemy engine, created on first use.
+    """
+    global _engine
+    if _engine is None:
+        options = get_pool_options()
+        pre_ping = options.pop('pre_ping')
+        _engine = sa.create_engine(get_cfg().get('db', 'SA_ENGINE_URI'), poolclass=TimedQueuePool, **options)
+        _protect_engine(_engine, pre_ping=pre_ping)
+    return _engine
+
+
+def get_pool_stats():
+    """
+    :return: A dict of connection pool metrics: current pool usage, plus checkout counts and wait times.
+    """
+    stats = dict(_pool_stats)
+    if _engine is not None:
+        stats.update({'size': _engine.pool.size(), 'checkedin': _engine.pool.checkedin(),
+                      'checkedout': _engine.pool.checkedout(), 'overflow': _engine.pool.overflow()})
+    return stats
+
+
+def get_scoped_session():
+    """
+    :return: The thread local sqlalchemy session registry for this process, created on first use.
+             Call remove() on it when a thread is done with its session.
+    """
+    global _sessionmaker, _scoped_session, _session_pid
+    if _scoped_session is None or _session_pid != os.getpid():
+        _sessionmaker = orm.sessionmaker(bind=get_engine())
+        _scoped_session = orm.scoped_session(_sessionmaker)
+        _session_pid = os.getpid()
+    return _scoped_session
+
+
+@contextlib.contextmanager
+def session_scope(session=None):
+    """
+    Use the given session, or if None, a short lived session that is closed afterwards,
+    so no transaction or pooled connection is left open between calls.
+    """
+    if session is not None:
+        yield session
+        return
+    get_scoped_session()
+    session = _sessionmaker()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def get_session():
+    """
+    :return: The default sqlalchemy session for this process and thread, created on first use.
+    """
+    return get_scoped_session()()
+
+
+def _create_index(eng, index):
+    """
+    Create an index. On Postgres it is built CONCURRENTLY, so writes to the table aren't locked out
+    for the whole build, and IF NOT EXISTS, so workers starting together don't trip over each other.
+    """
+    if eng.dialect.name != 'postgresql':
+        index.create(bind=eng)
+        return
+    ddl = str(sa.schema.CreateIndex(index).compile(dialect=eng.dialect))
+    ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY IF NOT EXISTS", 1)
+    # CONCURRENTLY can't run inside a transaction
+    with eng.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(ddl)
+
+
+def ensure_indexes(eng=None):
+    """
+    Create any of the INDEXES missing from existing tables.
+    An index created by another process in the meantime is not an error.
+
+    :return: The names of the indexes created.
+    :rtype: list
+    """
+    eng = eng or get_engine()
+    inspector = sa.inspect(eng)
+    existing = {}
+    created = []
+    for index in INDEXES:
+        tname = index.table.name
+        if tname not in existing:
+            existing[tname] = set(ix['name'] for ix in inspector.get_indexes(tname))
+        if index.name in existing[tname]:
+            continue
+        try:
+            _create_index(eng, index)
+        except exc.DBAPIError:
+            if index.name not in set(ix['name'] for ix in sa.inspect(eng).get_indexes(tname)):
+                raise
+        else:
+            created.append(index.name)
+        existing[tname].add(index.name)
+    return created
+
+
+def setup_schema():
+    """
+    Create any missing tables and indexes. Only runs once per process.
+    """
+    global _schema_ready
+    if not _schema_ready:
+        setup_database(get_engine(), modules=[wm, em, um])
+        ensure_indexes()
+        _schema_ready = True
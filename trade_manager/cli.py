@@ -1,15 +1,46 @@
 import argparse
+import datetime
+import shlex
 import sys
 import time
 from ledger import Amount
-from tapp_config import setup_redis
-from trade_manager import ses
-from trade_manager.plugin import sync_ticker, get_ticker, sync_orders, make_ledger, get_orders, cancel_orders, \
-    get_balances, sync_balances, get_trades, sync_trades, create_order, sync_credits, sync_debits, add_active_market, \
-    rem_active_market, set_preferred_exchange, get_preferred_exchange, sync_book, get_commodity_config, \
-    set_commodity_config
-
-red = setup_redis()
+import trade_manager
+from trade_manager import get_session, get_scoped_session
+from trade_manager.plugin import get_redis, sync_ticker, get_ticker, PriceSnapshot, sync_orders, make_ledger, \
+    get_orders, cancel_orders, get_balances, sync_balances, get_trades, sync_trades, create_order, sync_credits, \
+    sync_debits, add_active_market, rem_active_market, set_preferred_exchange, get_preferred_exchange, sync_book, \
+    get_commodity_config, get_commodity_configs, set_commodity_config, write_ledger, update_ledger_file, \
+    verify_ledger_file
+
+# commands that use the database, and so need a session
+DB_COMMANDS = ['ledger', 'order', 'trade', 'balance']
+
+try:
+    read_line = raw_input
+except NameError:
+    read_line = input
+
+
+def parse_time(value):
+    """
+    Parse a command line time, given as a unix timestamp or an ISO date or datetime (UTC).
+    """
+    try:
+        return datetime.datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid time: %r" % value)
+
+
+def add_page_arguments(parser):
+    parser.add_argument("--since", type=parse_time, help='Only include rows at or after this time.')
+    parser.add_argument("--until", type=parse_time, help='Only include rows before this time.')
+    parser.add_argument("--limit", type=int, help='The maximum number of rows to get.')
 
 
 def handle_ticker_command(argv, parsers):
@@ -19,27 +50,51 @@ def handle_ticker_command(argv, parsers):
     parser.add_argument("-e", help='The exchange to get a ticker for.')
     args = parser.parse_args(argv)
     if args.subcommand == "get":
-        return get_ticker(args.e, args.m, red=red)
+        return get_ticker(args.e, args.m, red=get_redis())
     elif args.subcommand == "sync":
         sync_ticker(args.e, args.m)
 
 
-def handle_ledger_command(argv, parsers, session=ses):
+def handle_ledger_command(argv, parsers, session=None):
     parser = argparse.ArgumentParser(parents=parsers)
-    parser.add_argument("subcommand", choices=["get", "sync"], help='The ledger sub-command to run.')
+    parser.add_argument("subcommand", choices=["get", "sync", "verify"], help='The ledger sub-command to run.')
     parser.add_argument("-e", help='The exchange to get a ledger for.')
+    parser.add_argument("--output", help="A file to stream the ledger to, or '-' for stdout.")
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only append entries newer than the last checkpoint of the output file.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rewrite the whole output file. With verify, only if it does not match.')
     parser.add_argument('--rescan', dest='rescan', action='store_true')
     parser.add_argument('--no-rescan', dest='rescan', action='store_false')
     parser.set_defaults(rescan=False)
     args = parser.parse_args(argv)
-    if args.subcommand == "get":
-        return make_ledger(exchange=args.e, session=session)
+    if (args.subcommand == "verify" or args.incremental) and args.output in (None, '-'):
+        parser.error("an --output file is required")
+    if args.subcommand == "verify":
+        if verify_ledger_file(args.output, exchange=args.e, session=session):
+            return "%s matches the ledger" % args.output
+        elif args.rebuild:
+            count = update_ledger_file(args.output, exchange=args.e, session=session, rebuild=True)
+            return "%s did not match, rebuilt with %s ledger entries" % (args.output, count)
+        return "%s does not match the ledger" % args.output
+    elif args.subcommand == "get":
+        if args.incremental:
+            count = update_ledger_file(args.output, exchange=args.e, session=session, rebuild=args.rebuild)
+            return "wrote %s ledger entries to %s" % (count, args.output)
+        elif args.output == '-':
+            write_ledger(sys.stdout, exchange=args.e, session=session)
+        elif args.output is not None:
+            with open(args.output, 'w') as out:
+                count = write_ledger(out, exchange=args.e, session=session)
+            return "wrote %s ledger entries to %s" % (count, args.output)
+        else:
+            return make_ledger(exchange=args.e, session=session)
     elif args.subcommand == "sync":
         sync_credits(exchange=args.e, rescan=args.rescan)
         sync_debits(exchange=args.e, rescan=args.rescan)
 
 
-def handle_order_command(argv, parsers, session=ses):
+def handle_order_command(argv, parsers, session=None):
     oparser = argparse.ArgumentParser(parents=parsers, add_help=False)
     oparser.add_argument("subcommand", choices=['get', 'sync', 'create', 'cancel'], help='Order sub-commands')
 
@@ -56,14 +111,16 @@ def handle_order_command(argv, parsers, session=ses):
         return handle_cancel_order(argv, parsers)
 
 
-def handle_get_order(argv, parsers, session=ses):
+def handle_get_order(argv, parsers, session=None):
     oparser = argparse.ArgumentParser(parents=parsers)
     oparser.add_argument("--oid", help='The order id.')
     oparser.add_argument("--order_id", help='The order order_id.')
     oparser.add_argument("-m", help='The order market.')
     oparser.add_argument("-e", help='The order exchange.')
+    add_page_arguments(oparser)
     args = oparser.parse_args(argv)
-    return get_orders(exchange=args.e, market=args.m, oid=args.oid, order_id=args.order_id, session=session)
+    return get_orders(exchange=args.e, market=args.m, oid=args.oid, order_id=args.order_id, session=session,
+                      since=args.since, until=args.until, limit=args.limit)
 
 
 def handle_sync_order(argv, parsers):
@@ -77,7 +134,7 @@ def handle_sync_order(argv, parsers):
     sync_orders(args.e, data)
 
 
-def handle_create_order(argv, parsers, session=ses):
+def handle_create_order(argv, parsers, session=None):
     oparser = argparse.ArgumentParser(parents=parsers)
     oparser.add_argument("side", choices=['bid', 'ask'], help='The order side')
     oparser.add_argument("amount", help='The order amount')
@@ -99,7 +156,7 @@ def handle_cancel_order(argv, parsers):
     return cancel_orders(args.e, args.m, side=args.s, oid=args.oid, order_id=args.order_id)
 
 
-def handle_balance_command(argv, parsers, session=ses):
+def handle_balance_command(argv, parsers, session=None):
     bparser = argparse.ArgumentParser(parents=parsers)
     bparser.add_argument("subcommand", choices=["get", "sync", "summary"], help='The balance sub-command to run.')
     bparser.add_argument("-e", help='The exchange.')
@@ -117,11 +174,12 @@ def handle_balance_command(argv, parsers, session=ses):
         return get_balance_summary(session=session)
 
 
-def get_balance_summary(session=ses):
-    bals = get_balances(session=session)
+def get_balance_summary(session=None):
+    bals = get_balances(session=session, by_exchange=True)
     resp = "\n_______ %s _______\n" % time.asctime(time.gmtime(time.time()))
     usdtotal = Amount("0 USD")
     details = {}
+    snapshot = PriceSnapshot(commodities=[str(amount.commodity) for amount in bals[0]], red=get_redis())
     for amount in bals[0]:
         comm = str(amount.commodity)
         if comm == 'USD':
@@ -129,11 +187,10 @@ def get_balance_summary(session=ses):
             details['USD'] = {'index': inde, 'amount': amount}
             usdtotal = usdtotal + amount
         else:
-            ticker = get_ticker(market="%s_USD" % comm, red=red)
-            if not ticker:
+            inde = snapshot.get_usd_price(comm)
+            if inde is None:
                 resp += "skipping inactive bal %s\n" % amount
                 continue
-            inde = ticker.calculate_index()
             details[comm] = {'index': inde, 'amount': Amount("%s USD" % amount.number()) * inde}
             usdtotal = usdtotal + details[comm]['amount']
     resp += "\nTotal Value:\t$%s\n\n" % usdtotal.number()
@@ -146,10 +203,15 @@ def get_balance_summary(session=ses):
             resp += "{0:16s}\t==\t${1:8.2f} ({2:3.2f}%)\t@ ${3:8.4f}\n".format(amount, damount,
                                                                                percent,
                                                                                details[comm]['index'].to_double())
+
+    resp += "\nBy Exchange:\n"
+    for exchange in sorted(bals[2]):
+        for amount in bals[2][exchange][0]:
+            resp += "{0:16s}\t{1}\n".format(exchange, amount)
     return resp
 
 
-def handle_trade_command(argv, parsers, session=ses):
+def handle_trade_command(argv, parsers, session=None):
     tparser = argparse.ArgumentParser(parents=parsers)
     tparser.add_argument("subcommand", choices=["get", "sync"], help='The trade sub-command to run.')
     tparser.add_argument("-m", help='The market to get trades for.')
@@ -157,11 +219,13 @@ def handle_trade_command(argv, parsers, session=ses):
     tparser.add_argument("--tid", help='The trade id to get.')
     tparser.add_argument('--rescan', dest='rescan', action='store_true')
     tparser.add_argument('--no-rescan', dest='rescan', action='store_false')
+    add_page_arguments(tparser)
     tparser.set_defaults(rescan=False)
     args = tparser.parse_args(argv)
 
     if args.subcommand == "get":
-        return get_trades(args.e, args.m, args.tid, session=session)
+        return get_trades(args.e, args.m, args.tid, session=session, since=args.since, until=args.until,
+                          limit=args.limit)
     elif args.subcommand == "sync":
         return sync_trades(exchange=args.e, market=args.m, rescan=args.rescan)
 
@@ -187,16 +251,20 @@ def handle_commodity_command(argv, parsers):
     parser = argparse.ArgumentParser(parents=parsers)
     parser.add_argument("subcommand", choices=["get", "set"],
                         help='The configure commodity sub-command to run.')
-    parser.add_argument("commodity", help='The commodity to configure.')
-    parser.add_argument("weight", help='The weight to give this commodity in deciding exposure.'
-                                       ' Higher == more exposure')
-    parser.add_argument("floor", help='The commodity percent of total holdings floor.')
-    parser.add_argument("target", help='The commodity percent of total holdings target.')
-    parser.add_argument("ceil", help='The commodity percent of total holdings ceiling.')
+    parser.add_argument("commodity", nargs='?', help='The commodity to configure. Get all if omitted.')
+    parser.add_argument("weight", nargs='?', help='The weight to give this commodity in deciding exposure.'
+                                                  ' Higher == more exposure')
+    parser.add_argument("floor", nargs='?', help='The commodity percent of total holdings floor.')
+    parser.add_argument("target", nargs='?', help='The commodity percent of total holdings target.')
+    parser.add_argument("ceil", nargs='?', help='The commodity percent of total holdings ceiling.')
     args = parser.parse_args(argv)
     if args.subcommand == "get":
+        if args.commodity is None:
+            return get_commodity_configs()
         return get_commodity_config(args.commodity)
     elif args.subcommand == "set":
+        if None in (args.commodity, args.weight, args.floor, args.target, args.ceil):
+            parser.error("set requires commodity, weight, floor, target and ceil")
         set_commodity_config(args.commodity, weight=args.weight, cfloor=args.floor, ctarget=args.target,
                              cceil=args.ceil)
 
@@ -213,16 +281,91 @@ def handle_commodity_command(argv, parsers):
 #         sync_book(args.e, args.m)
 
 
-def handle_command(argv=sys.argv[1:], session=ses):
+def end_transaction(session=None):
+    """
+    End the transaction a command left open, so the connection isn't left idle in transaction
+    and the next command reads fresh rows.
+
+    :param session: The sqlalchemy session the command used, or None if it used the scoped session.
+    """
+    if session is not None:
+        session.rollback()
+    elif trade_manager._scoped_session is not None:
+        get_scoped_session().remove()
+
+
+def run_commands(lines, session=None):
+    """
+    Run many tradem commands in this process, sharing one session and redis connection.
+    Each command's transaction is ended once its result has been used.
+
+    :param lines: An iterable of command lines, i.e. "ticker get -m BTC_USD". Blank lines and # comments are skipped.
+    :param session: The sqlalchemy session. (optional)
+    :return: A generator of (command line, result, seconds taken) tuples.
+    """
+    for line in lines:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        start = time.time()
+        try:
+            result = handle_command(shlex.split(line), session=session)
+        except SystemExit:
+            result = None  # argparse already printed the usage or error
+        except Exception as e:
+            result = "error: %s" % e
+        try:
+            yield line, result, time.time() - start
+        finally:
+            end_transaction(session)
+
+
+def print_command_results(results, out=sys.stdout):
+    for line, result, elapsed in results:
+        if result is not None:
+            out.write("%s\n" % (result,))
+        out.write("# %.4fs %s\n" % (elapsed, line))
+        out.flush()
+
+
+def handle_batch_command(argv, parsers, session=None):
+    parser = argparse.ArgumentParser(parents=parsers)
+    parser.add_argument("-f", help='A file with one command per line. Defaults to stdin.')
+    args = parser.parse_args(argv)
+    lines = open(args.f, 'r') if args.f else sys.stdin
+    try:
+        print_command_results(run_commands(lines, session=session))
+    finally:
+        if args.f:
+            lines.close()
+
+
+def handle_shell_command(argv, parsers, session=None):
+    parser = argparse.ArgumentParser(parents=parsers)
+    parser.parse_args(argv)
+    while True:
+        try:
+            line = read_line("tradem> ")
+        except EOFError:
+            print("")
+            break
+        if line.strip() in ('exit', 'quit'):
+            break
+        print_command_results(run_commands([line], session=session))
+
+
+def handle_command(argv=sys.argv[1:], session=None):
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument("command", choices=['ticker', 'ledger', 'order', 'trade', 'balance', 'address', 'market',
-                                            'commodity'],
+                                            'commodity', 'batch', 'shell'],
                         help="'%(prog)s <command> help' for usage details")
     if len(argv) == 0:
         parser.print_help()
         sys.exit()
     argvlimited = [argv[0]]
     args = parser.parse_args(argvlimited)
+    if session is None and args.command in DB_COMMANDS:
+        session = get_session()
     if args.command == 'ticker':
         return handle_ticker_command(argv, [parser])
     elif args.command == 'ledger':
@@ -239,6 +382,10 @@ def handle_command(argv=sys.argv[1:], session=ses):
         return handle_market_command(argv, [parser])
     elif args.command == 'commodity':
         return handle_commodity_command(argv, [parser])
+    elif args.command == 'batch':
+        return handle_batch_command(argv, [parser], session=session)
+    elif args.command == 'shell':
+        return handle_shell_command(argv, [parser], session=session)
 
 
 if __name__ == "__main__":
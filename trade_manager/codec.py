@@ -0,0 +1,113 @@
+"""
+Ticker encodings for redis. Tickers are stored as JSON by default, or in a compact fixed layout:
+
+    magic 'TK\x01' | bid, ask, high, low, volume, last as int64 satoshis | time as int64 microseconds since the epoch
+    | market length, market | exchange length, exchange
+
+decode_ticker reads either, so plugins writing JSON keep working alongside ones writing binary.
+Tickers with an amount that isn't a whole number of satoshis, or doesn't fit in an int64, are written as JSON.
+Run this module to compare the cost and size of the two.
+"""
+import datetime
+import math
+import struct
+import time
+
+from sqlalchemy_models import jsonify2, exchange as em
+
+TICKER_MAGIC = b'TK\x01'
+TICKER_HEADER = struct.Struct('>3s7q')
+SATOSHI = 10 ** 8
+EPOCH = datetime.datetime(1970, 1, 1)
+TICKER_AMOUNTS = ('bid', 'ask', 'high', 'low', 'volume', 'last')
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def _pack_string(value):
+    value = value.encode('utf-8')
+    return struct.pack('>B', len(value)) + value
+
+
+def _unpack_string(raw, offset):
+    length = struct.unpack_from('>B', raw, offset)[0]
+    offset += 1
+    return raw[offset:offset + length].decode('utf-8'), offset + length
+
+
+def _to_satoshis(value):
+    """
+    :return: The value as an int64 number of satoshis, or None if it would not round trip.
+    """
+    if math.isnan(value) or math.isinf(value):
+        return None
+    scaled = value * SATOSHI
+    satoshis = int(round(scaled))
+    # allow for float error in the scaling, but not for sub-satoshi digits
+    if not INT64_MIN <= satoshis <= INT64_MAX or abs(scaled - satoshis) > max(1e-6, abs(scaled) * 1e-14):
+        return None
+    return satoshis
+
+
+def encode_ticker(ticker, binary=False):
+    """
+    Encode a Ticker for storage in redis.
+
+    :param Ticker ticker: The ticker to encode.
+    :param bool binary: Use the compact binary layout instead of JSON, if every amount fits it.
+    :rtype: bytes
+    """
+    amounts = [_to_satoshis(getattr(ticker, attr).to_double()) for attr in TICKER_AMOUNTS] if binary else [None]
+    if None in amounts:
+        jtick = jsonify2(ticker, 'Ticker')
+        ticker.load_commodities()  # jsonify2 replaces Amounts with floats
+        return jtick
+    delta = ticker.time - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+    return TICKER_HEADER.pack(TICKER_MAGIC, *(amounts + [micros])) + _pack_string(ticker.market) + \
+        _pack_string(ticker.exchange)
+
+
+def decode_ticker(raw):
+    """
+    Decode a Ticker from redis, in either encoding.
+
+    :param bytes raw: The encoded ticker.
+    :rtype: Ticker
+    """
+    if not raw.startswith(TICKER_MAGIC):
+        if isinstance(raw, bytes) and not isinstance(raw, str):
+            raw = raw.decode('utf-8')
+        return em.Ticker.from_json(raw)
+    values = TICKER_HEADER.unpack_from(raw)
+    amounts = [float(value) / SATOSHI for value in values[1:7]]
+    market, offset = _unpack_string(raw, TICKER_HEADER.size)
+    exchange, offset = _unpack_string(raw, offset)
+    return em.Ticker(*(amounts + [market, exchange]), time=EPOCH + datetime.timedelta(microseconds=values[7]))
+
+
+def benchmark(count=10000):
+    """
+    Time encoding and decoding a ticker in each encoding.
+
+    :return: A dict of encoding -> (encoded size in bytes, seconds per encode, seconds per decode)
+    """
+    ticker = em.Ticker(0.00123456, 0.00123789, 0.0013, 0.0012, 123456.789, 0.00123555, 'DASH_BTC', 'poloniex')
+    results = {}
+    for name, binary in (('json', False), ('binary', True)):
+        start = time.time()
+        for i in range(count):
+            raw = encode_ticker(ticker, binary=binary)
+        encode = (time.time() - start) / count
+        start = time.time()
+        for i in range(count):
+            decode_ticker(raw)
+        decode = (time.time() - start) / count
+        results[name] = (len(raw), encode, decode)
+    return results
+
+
+if __name__ == "__main__":
+    for name, (size, encode, decode) in sorted(benchmark().items()):
+        print("{0:8s}{1:5d} bytes\tencode {2:8.1f}us\tdecode {3:8.1f}us".format(
+            name, size, encode * 10 ** 6, decode * 10 ** 6))
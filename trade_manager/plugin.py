@@ -1,17 +1,118 @@
 import collections
 import datetime
+import heapq
 import json
+import os
+import re
+import threading
 import time
+import redis
 from ledger import Amount
 from ledger import commodities, Balance
 
-from sqlalchemy_models import sa, Base, create_session_engine
+from sqlalchemy_models import sa, Base
 from sqlalchemy_models.util import filter_query_by_attr, multiply_tickers
 from tapp_config import get_config, setup_redis
 from tappmq.tappmq import publish, MQHandlerBase, get_running_workers
-from trade_manager import em, um, wm, ses, EXCHANGES
+from trade_manager import em, um, wm, EXCHANGES, session_scope, setup_schema
+from trade_manager.codec import encode_ticker, decode_ticker
+from trade_manager.pricegraph import PriceGraph
+from trade_manager.reconcile import reconcile_orders, PRICE_TOLERANCE, SIZE_TOLERANCE
 
-red = setup_redis()
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+_red = None
+_red_pid = None
+
+
+def get_redis():
+    """
+    :return: The redis client for this process, created on first use.
+    """
+    global _red, _red_pid
+    if _red is None or _red_pid != os.getpid():
+        _red = setup_redis()
+        _red_pid = os.getpid()
+    return _red
+
+
+TRADE_FIELDS = ('market', 'tid', 'trade_side', 'price', 'amount', 'fee', 'fee_side', 'dtime')
+ORDER_FIELDS = ('price', 'amount', 'market', 'side', 'order_id', 'create_time', 'change_time', 'exec_amount', 'state')
+
+
+def _as_kwargs(args, fields):
+    """
+    Normalize a tuple of positional arguments, or a dict of keyword arguments, to a dict.
+    """
+    if isinstance(args, dict):
+        return args
+    return dict(zip(fields, args))
+
+
+class KnownTradeCache(object):
+    """
+    A bounded, least recently used set of trade_ids known to be in the database, kept per market.
+    Only trade_ids confirmed by the database are cached, so a rolled back insert is never mistaken as known.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.markets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def is_warm(self, market):
+        return market in self.markets
+
+    def check(self, market, trade_id):
+        """
+        Check if a trade_id is known, counting the hit or miss.
+
+        :rtype: bool
+        """
+        known = self.markets.get(market)
+        if known is not None and trade_id in known:
+            known[trade_id] = known.pop(trade_id)  # most recently used goes last
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, market, trade_id):
+        known = self.markets.setdefault(market, collections.OrderedDict())
+        known.pop(trade_id, None)
+        known[trade_id] = True
+        while len(known) > self.size:
+            known.popitem(last=False)
+
+    def stats(self):
+        """
+        :return: The hit and miss counters, and the number of cached trade_ids.
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': sum(len(known) for known in self.markets.values())}
+
+
+class ExchangeNonce(Base):
+    """
+    The last nonce used for an exchange API key.
+    """
+    __tablename__ = "exchange_nonce"
+    __table_args__ = (sa.UniqueConstraint('exchange', 'key'),)
+
+    id = sa.Column(sa.Integer, sa.Sequence('exchange_nonce_id_seq'), primary_key=True,
+                   doc="primary key")
+    exchange = sa.Column(sa.String(16), nullable=False)
+    key = sa.Column(sa.String(80), nullable=False)
+    nonce = sa.Column(sa.BigInteger, nullable=False, default=0)
+
+
+# (exchange, key) pairs known to have a nonce row
+_nonce_rows = set()
 
 
 class ExchangePluginBase(MQHandlerBase):
@@ -22,12 +123,20 @@ class ExchangePluginBase(MQHandlerBase):
     """
     NAME = 'Base'
     KEY = 'PubKey'
+    TRADE_PAGE_SIZE = 1000
+    TRADE_CACHE_SIZE = 10000
+    ORDER_PAGE_SIZE = 1000
+    NONCE_BLOCK_SIZE = 1
+    # save tickers in the compact binary encoding. Readers of this project decode either.
+    BINARY_TICKERS = False
+    _nonce_block = None
     _user = None
     session = None
 
     def __init__(self, key=None, secret=None, session=None, engine=None, red=None, cfg=None):
         super(ExchangePluginBase, self).__init__(key=key, secret=secret, session=session, engine=engine, red=red,
                                                  cfg=cfg)
+        setup_schema()
         # ensure all are active in redis
         add_active_markets(self.NAME.lower(), json.loads(self.cfg.get(self.NAME.lower(), 'active_markets')))
         self.active_markets = get_active_markets(self.NAME.lower())
@@ -35,28 +144,65 @@ class ExchangePluginBase(MQHandlerBase):
         for mark in self.active_markets:
             self.active_currencies = self.active_currencies.union(set(mark.split("_")))
         assert len(self.active_currencies) > 0
+        self.trade_cache = KnownTradeCache(self.TRADE_CACHE_SIZE)
 
     """
     Optional nonce helpers. Most exchanges can simply use a timestamp.
     """
 
     def get_nonce_db(self):
-        class DBNonce(Base):
-            __tablename__ = "%s_%s_nonce" % (self.NAME.lower(), self.key)
+        """
+        Get the nonce model, ensuring its table and a row for this exchange and key exist.
 
-            id = sa.Column(sa.Integer, sa.Sequence('nonce_seq'), primary_key=True,
-                           doc="primary key")
-            exchange = sa.Column(sa.String(16), nullable=False)
-            key = sa.Column(sa.String(80), nullable=False)
+        :return: The ExchangeNonce model.
+        """
+        if (self.NAME.lower(), self.key) not in _nonce_rows:
+            eng = self.session.get_bind()
+            ExchangeNonce.__table__.create(eng, checkfirst=True)
+            table = ExchangeNonce.__table__
+            with eng.begin() as conn:
+                exists = conn.execute(sa.select([table.c.id]).where(table.c.exchange == self.NAME.lower())
+                                      .where(table.c.key == self.key)).first()
+            if exists is None:
+                try:
+                    with eng.begin() as conn:
+                        conn.execute(table.insert().values(exchange=self.NAME.lower(), key=self.key, nonce=0))
+                except sa.exc.IntegrityError:
+                    pass  # another worker created it first
+            _nonce_rows.add((self.NAME.lower(), self.key))
+        return ExchangeNonce
+
+    def _reserve_nonces(self, count=1, start=None):
+        """
+        Atomically advance the stored nonce, in its own transaction.
 
-        return DBNonce
+        :param int count: The number of nonces to reserve.
+        :param int start: The lowest acceptable nonce to reserve from. (optional)
+        :return: The highest nonce reserved.
+        :rtype: int
+        """
+        table = self.get_nonce_db().__table__
+        value = table.c.nonce + count
+        if start is not None:
+            value = sa.func.greatest(value, start + count - 1)
+        with self.session.get_bind().begin() as conn:
+            return conn.execute(table.update().where(table.c.exchange == self.NAME.lower())
+                                .where(table.c.key == self.key)
+                                .values(nonce=value).returning(table.c.nonce)).scalar()
 
     def next_nonce(self):
-        """Atomically increment and get a nonce for an exchange."""
-        nonce = self.get_nonce_db()()
-        self.session.add()
-        self.session.commit()
-        return nonce.id
+        """
+        Atomically increment and get a nonce for an exchange.
+        If NONCE_BLOCK_SIZE is more than 1, nonces are reserved that many at a time, and served from memory.
+        Only use block reservation if a single worker uses the key, since nonces from different
+        workers' blocks would not be increasing.
+        """
+        if self._nonce_block is None or self._nonce_block[0] > self._nonce_block[1]:
+            high = self._reserve_nonces(self.NONCE_BLOCK_SIZE)
+            self._nonce_block = [high - self.NONCE_BLOCK_SIZE + 1, high]
+        nonce = self._nonce_block[0]
+        self._nonce_block[0] += 1
+        return nonce
 
     def create_nonce(self, nonce):
         """
@@ -64,12 +210,10 @@ class ExchangePluginBase(MQHandlerBase):
 
         :param int nonce: an integer that will be incremented on each
             next_nonce call.
-        :return: nonce if an entry was created, None otherwise.
+        :return: the first nonce at or above the requested one, which is used by this call.
         """
-        n = self.next_nonce()
-        while n < nonce:
-            n = self.next_nonce()
-        return n
+        self._nonce_block = None
+        return self._reserve_nonces(1, start=nonce)
 
     """
     Classmethods for manipulating data types.
@@ -134,11 +278,39 @@ class ExchangePluginBase(MQHandlerBase):
     """
     Normalization helpers.
     """
+    def warm_trade_cache(self, market):
+        """
+        Load the most recent trade_ids for a market into the known trade cache.
+
+        :param str market: The market to warm the cache for.
+        """
+        self.trade_cache.markets.setdefault(market, collections.OrderedDict())
+        recent = self.session.query(em.Trade.trade_id) \
+            .filter(em.Trade.exchange == self.NAME.lower()) \
+            .filter(em.Trade.market == market) \
+            .order_by(em.Trade.time.desc()).limit(self.TRADE_CACHE_SIZE)
+        for row in reversed(recent.all()):
+            self.trade_cache.add(market, row.trade_id)
+
+    def is_known_trade(self, market, trade_id):
+        """
+        Check the known trade cache for a trade_id, warming it from the database on first use.
+
+        :rtype: bool
+        """
+        if not self.trade_cache.is_warm(market):
+            self.warm_trade_cache(market)
+        return self.trade_cache.check(market, trade_id)
+
     def add_trade(self, market, tid, trade_side, price, amount, fee, fee_side, dtime):
         tofind = '%s|%s' % (self.NAME.lower(), tid)
+        if self.is_known_trade(market, tofind):
+            self.logger.debug("; %s already known" % tid)
+            return
         found = self.session.query(em.Trade) \
             .filter(em.Trade.trade_id == tofind).count()
         if found != 0:
+            self.trade_cache.add(market, tofind)
             self.logger.debug("; %s already known" % tid)
             return
         trade = em.Trade(tid, self.NAME.lower(), market, trade_side, amount, price, fee, fee_side, dtime)
@@ -146,6 +318,53 @@ class ExchangePluginBase(MQHandlerBase):
         self.logger.info("added trade %s" % trade)
         return trade
 
+    def add_trades(self, trades):
+        """
+        Add many trades at once, skipping any that are already known.
+        Trades are checked against the database one page at a time, with a single query
+        per page, and the new ones are bulk inserted.
+
+        :param trades: An iterable of add_trade argument tuples, or dicts of add_trade keyword arguments.
+        :return: The number of new trades added, and the number already known. (new, known)
+        :rtype: tuple
+        """
+        new = 0
+        known = 0
+        page = []
+        for targs in trades:
+            page.append(_as_kwargs(targs, TRADE_FIELDS))
+            if len(page) >= self.TRADE_PAGE_SIZE:
+                pnew, pknown = self._add_trade_page(page)
+                new, known, page = new + pnew, known + pknown, []
+        if len(page) > 0:
+            pnew, pknown = self._add_trade_page(page)
+            new, known = new + pnew, known + pknown
+        self.logger.info("added %s trades, %s already known" % (new, known))
+        return new, known
+
+    def _add_trade_page(self, page):
+        pending = collections.OrderedDict()
+        known = 0
+        for targs in page:
+            tofind = '%s|%s' % (self.NAME.lower(), targs['tid'])
+            if tofind in pending or self.is_known_trade(targs['market'], tofind):
+                known += 1
+            else:
+                pending[tofind] = targs
+        if len(pending) > 0:
+            found = self.session.query(em.Trade.trade_id).filter(em.Trade.trade_id.in_(list(pending)))
+            for row in found:
+                self.trade_cache.add(pending.pop(row.trade_id)['market'], row.trade_id)
+                known += 1
+        new = []
+        for targs in pending.values():
+            new.append(em.Trade(targs['tid'], self.NAME.lower(), targs['market'], targs['trade_side'],
+                                targs['amount'], targs['price'], targs['fee'], targs['fee_side'],
+                                targs.get('dtime')))
+        if len(new) > 0:
+            self.session.bulk_save_objects(new)
+        return len(new), known
+
     def update_balance(self, currency, total, available=None, reference=""):
         bal = self.session.query(wm.Balance).filter(wm.Balance.user_id == self.manager_user.id) \
                 .filter(wm.Balance.currency == currency).one_or_none()
@@ -168,23 +387,87 @@ class ExchangePluginBase(MQHandlerBase):
         order = self.session.query(em.LimitOrder) \
             .filter(em.LimitOrder.order_id == '%s|%s' % (prefix, order_id)).one_or_none()
         if order is not None:
-            try:
-                assert order.market == market
-                assert order.side == side
-            except AssertionError:
-                return
-            if order.exec_amount.to_double() == exec_amount and order.state == state:
-                return
-            order.order_id = "%s|%s" % (self.NAME.lower(), order_id)
-            order.price = price
-            order.amount = amount
-            order.change_time = datetime.datetime.utcnow()
-            order.state = state
-            order.exec_amount = exec_amount
-        else:
-            order = em.LimitOrder(price, amount, market, side, self.NAME.lower(), order_id, create_time, change_time,
-                                  exec_amount, state)
-            self.session.add(order)
+            return self._update_order(order, price, amount, market, side, order_id, exec_amount, state)
+        order = em.LimitOrder(price, amount, market, side, self.NAME.lower(), order_id, create_time, change_time,
+                              exec_amount, state)
+        self.session.add(order)
+        self.logger.info("added order %s" % order)
+        return order
+
+    def add_orders(self, orders):
+        """
+        Add or update many orders at once.
+        All candidate orders, under both the tmp and exchange order_id prefixes, are fetched
+        with one query per page. Orders with unchanged exec_amount and state are skipped,
+        and the session is flushed once at the end.
+
+        :param orders: An iterable of add_order argument tuples, or dicts of add_order keyword arguments.
+        :return: The orders that were added or changed.
+        :rtype: list
+        """
+        changed = []
+        page = []
+        for oargs in orders:
+            page.append(_as_kwargs(oargs, ORDER_FIELDS))
+            if len(page) >= self.ORDER_PAGE_SIZE:
+                changed.extend(self._add_order_page(page))
+                page = []
+        if len(page) > 0:
+            changed.extend(self._add_order_page(page))
+        if len(changed) > 0:
+            self.session.flush()
+        return changed
+
+    def _add_order_page(self, page):
+        candidates = set()
+        for oargs in page:
+            candidates.add('tmp|%s' % oargs.get('order_id'))
+            candidates.add('%s|%s' % (self.NAME.lower(), oargs.get('order_id')))
+        found = {}
+        for order in self.session.query(em.LimitOrder).filter(em.LimitOrder.order_id.in_(list(candidates))):
+            found[order.order_id] = order
+        changed = []
+        for oargs in page:
+            state = oargs.get('state', 'pending')
+            prefixes = ['tmp', self.NAME.lower()] if state == 'pending' else [self.NAME.lower(), 'tmp']
+            order = None
+            for prefix in prefixes:
+                order = found.get('%s|%s' % (prefix, oargs.get('order_id')))
+                if order is not None:
+                    break
+            if order is not None:
+                order = self._update_order(order, oargs['price'], oargs['amount'], oargs['market'], oargs['side'],
+                                           oargs.get('order_id'), oargs.get('exec_amount', 0), state)
+            else:
+                order = em.LimitOrder(oargs['price'], oargs['amount'], oargs['market'], oargs['side'],
+                                      self.NAME.lower(), oargs.get('order_id'), oargs.get('create_time'),
+                                      oargs.get('change_time'), oargs.get('exec_amount', 0), state)
+                self.session.add(order)
+                found[order.order_id] = order
+                self.logger.info("added order %s" % order)
+            if order is not None:
+                changed.append(order)
+        return changed
+
+    def _update_order(self, order, price, amount, market, side, order_id, exec_amount, state):
+        """
+        Apply an exchange's view of an order to a known LimitOrder.
+
+        :return: The order, or None if it did not match or was unchanged.
+        """
+        try:
+            assert order.market == market
+            assert order.side == side
+        except AssertionError:
+            return
+        if order.exec_amount.to_double() == exec_amount and order.state == state:
+            return
+        order.order_id = "%s|%s" % (self.NAME.lower(), order_id)
+        order.price = price
+        order.amount = amount
+        order.change_time = datetime.datetime.utcnow()
+        order.state = state
+        order.exec_amount = exec_amount
         self.logger.info("added order %s" % order)
         return order
 
@@ -203,11 +486,12 @@ class ExchangePluginBase(MQHandlerBase):
         raise NotImplementedError()
 
     def cancel_stale_orders(self):
+        tickers = get_tickers([(self.NAME, market) for market in self.active_markets], red=self.red)
         for market in self.active_markets:
-            rticker = get_ticker(self.NAME, market=market, red=self.red)  # use the redis version of ticker
-            ticker = em.Ticker.from_json(rticker)
-            index = ticker.get_index(market)
-            self.cancel_orders(market=market, price=index)
+            ticker = tickers[(self.NAME, market)]
+            if ticker is None:
+                continue
+            self.cancel_orders(market=market, price=ticker.calculate_index())
 
     def create_order(self, oid):
         """
@@ -218,6 +502,17 @@ class ExchangePluginBase(MQHandlerBase):
         """
         raise NotImplementedError()
 
+    def create_orders(self, oids):
+        """
+        Create many orders at once. By default each is created with create_order.
+        Override this if the exchange has a bulk order endpoint.
+
+        :param list oids: The ids of the LimitOrders to create.
+        :return: The results of creating each order.
+        :rtype: list
+        """
+        return [self.create_order(oid) for oid in oids]
+
     def sync_orders(self, market=None):
         """
         :param market : Some exchanges return all open orders in one call, while
@@ -275,32 +570,147 @@ class ExchangePluginBase(MQHandlerBase):
         """
         raise NotImplementedError()
 
+    def save_ticker(self, ticker):
+        """
+        Save a ticker synced from this exchange, and notify any subscribers.
+        Plugins should call this from sync_ticker.
+
+        :param Ticker ticker: The new ticker.
+        """
+        publish_ticker(ticker, red=self.red, binary=self.BINARY_TICKERS)
+
 
 """
 Redis command interface. Call these functions from anywhere and to any of the exchange managers.
 """
 
 
+ROUTING_VERSION_KEY = 'market_routing_version'
+# seconds between checks for routing changes made by other processes
+ROUTING_CHECK_INTERVAL = 1.0
+# the in process market -> exchange routing table
+_routing = {'version': None, 'checked': 0.0, 'preferred': {}, 'active': None}
+
+
+def _get_routing(red):
+    """
+    Get the routing table, discarding it if the routing version in redis has changed since it was built.
+    The version is checked at most once per ROUTING_CHECK_INTERVAL.
+    """
+    global _routing
+    now = time.time()
+    if now - _routing['checked'] >= ROUTING_CHECK_INTERVAL:
+        version = red.get(ROUTING_VERSION_KEY)
+        if version != _routing['version']:
+            _routing = {'version': version, 'checked': now, 'preferred': {}, 'active': None}
+        else:
+            _routing['checked'] = now
+    return _routing
+
+
+def invalidate_routing(red=None):
+    """
+    Discard the routing table in this and every other process, after a preferred exchange or active market change.
+    """
+    global _routing
+    if red is None:
+        red = get_redis()
+    version = red.incr(ROUTING_VERSION_KEY)
+    _routing = {'version': str(version), 'checked': time.time(), 'preferred': {}, 'active': None}
+
+
 def set_preferred_exchange(market, exchange):
+    red = get_redis()
     if exchange is None or exchange == '':
         red.delete('%s_preferred_exchange' % market)
     else:
         red.set('%s_preferred_exchange' % market, exchange)
+    invalidate_routing(red)
 
 
 def get_preferred_exchange(market):
-    exchange = red.get('%s_preferred_exchange' % market)
-    if exchange is None or exchange == "":
-        for ex in EXCHANGES:
-            active_markets = red.get('%s_active_markets' % ex)
-            if active_markets is not None and market in json.loads(active_markets):
-                return ex
-    else:
-        return exchange
+    return get_preferred_exchanges([market])[market]
+
+
+def get_preferred_exchanges(markets, red=None):
+    """
+    Get the preferred exchange for many markets.
+    Markets without a preferred exchange fall back to the first exchange with the market active.
+    Answers come from the in process routing table, and any markets not in it yet are looked up
+    in one redis round trip.
+
+    :param markets: The markets to look up.
+    :return: A dict of market -> exchange, or None if no exchange has the market active.
+    :rtype: dict
+    """
+    if red is None:
+        red = get_redis()
+    markets = set(markets)
+    routing = _get_routing(red)
+    missing = [market for market in markets if market not in routing['preferred']]
+    if len(missing) > 0:
+        pipe = red.pipeline(transaction=False)
+        for market in missing:
+            pipe.get('%s_preferred_exchange' % market)
+        if routing['active'] is None:
+            for ex in EXCHANGES:
+                pipe.smembers(_active_markets_key(ex, red))
+        replies = pipe.execute()
+        if routing['active'] is None:
+            routing['active'] = dict(zip(EXCHANGES, replies[len(missing):]))
+        for market, exchange in zip(missing, replies[:len(missing)]):
+            if exchange is None or exchange == "":
+                exchange = None
+                for ex in EXCHANGES:
+                    if market in routing['active'][ex]:
+                        exchange = ex
+                        break
+            routing['preferred'][market] = exchange
+    return dict((market, routing['preferred'][market]) for market in markets)
+
+
+# Copy a legacy JSON list of active markets into a set, if the set does not exist yet, then remove the JSON key.
+MIGRATE_ACTIVE_MARKETS = """
+if redis.call('exists', KEYS[1]) == 0 then
+    local legacy = redis.call('get', KEYS[2])
+    if legacy then
+        for _, market in ipairs(cjson.decode(legacy)) do
+            redis.call('sadd', KEYS[1], market)
+        end
+    end
+end
+redis.call('del', KEYS[2])
+return 1
+"""
+# exchanges whose active markets have been migrated by this process
+_migrated_active_markets = set()
+
+
+def _active_markets_key(exchange, red):
+    """
+    The redis key of the set of active markets for an exchange, migrating the legacy JSON key on first use.
+    """
+    key = '%s_active_market_set' % exchange
+    if exchange not in _migrated_active_markets:
+        red.eval(MIGRATE_ACTIVE_MARKETS, 2, key, '%s_active_markets' % exchange)
+        _migrated_active_markets.add(exchange)
+    return key
 
 
 def set_active_markets(exchange, active_markets):
-    red.set('%s_active_markets' % exchange, active_markets)
+    """
+    :param active_markets: A list of markets, or a JSON string of one.
+    """
+    if not isinstance(active_markets, list):
+        active_markets = json.loads(active_markets)
+    red = get_redis()
+    key = _active_markets_key(exchange, red)
+    pipe = red.pipeline()
+    pipe.delete(key)
+    if len(active_markets) > 0:
+        pipe.sadd(key, *active_markets)
+    pipe.execute()
+    invalidate_routing(red)
 
 
 def add_active_market(exchange, market):
@@ -308,9 +718,11 @@ def add_active_market(exchange, market):
 
 
 def add_active_markets(exchange, markets):
-    marks = get_active_markets(exchange)
-    active_markets = json.dumps(list(set(marks + markets)))
-    red.set('%s_active_markets' % exchange, active_markets)
+    if len(markets) == 0:
+        return
+    red = get_redis()
+    red.sadd(_active_markets_key(exchange, red), *markets)
+    invalidate_routing(red)
 
 
 def rem_active_market(exchange, market):
@@ -318,73 +730,340 @@ def rem_active_market(exchange, market):
 
 
 def rem_active_markets(exchange, markets):
-    active_markets = get_active_markets(exchange)
-    for mark in markets:
-        try:
-            active_markets.remove(mark)
-        except ValueError:
-            # safe to ignore; market was already inactive
-            continue
-    red.set('%s_active_markets' % exchange, json.dumps(active_markets))
+    if len(markets) == 0:
+        return
+    red = get_redis()
+    red.srem(_active_markets_key(exchange, red), *markets)
+    invalidate_routing(red)
 
 
 def get_active_markets(exchange):
-    active_markets = red.get('%s_active_markets' % exchange)
-    if active_markets is not None and len(active_markets) > 2:  # is not "[]"
-
-        markets = json.loads(active_markets)
-    else:
+    red = get_redis()
+    markets = sorted(red.smembers(_active_markets_key(exchange, red)))
+    if len(markets) == 0:
         cfg = get_config(name=exchange)
         markets = json.loads(cfg.get(exchange, 'active_markets'))
     return markets
 
 
+def get_exchange_markets(exchanges=None, red=None):
+    """
+    Get the active markets of many exchanges. Exchanges with no active markets in redis and no config
+    to fall back to are skipped. Any other error, such as a lost redis connection, is raised.
+
+    :param list exchanges: The exchanges to look up. (optional, defaults to the running exchange workers)
+    :return: A list of (exchange, market) tuples.
+    """
+    if exchanges is None:
+        exchanges = get_running_workers(EXCHANGES, red=red if red is not None else get_redis())
+    pairs = []
+    for exchange in exchanges:
+        try:
+            markets = get_active_markets(exchange)
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            continue
+        pairs.extend([(exchange, market) for market in markets])
+    return pairs
+
+
+COMMODITY_CONFIG_KEY = 'commodity_config'
+COMMODITY_CONFIG_DEFAULTS = {'weight': 1.0, 'floor': 0.0, 'target': 0.0, 'ceil': 0.0}
+# seconds the in process commodity configs are trusted before reloading from redis
+COMMODITY_CONFIG_TTL = 5.0
+# the in process commodity -> config cache, loaded from the COMMODITY_CONFIG_KEY hash
+_commodity_configs = {'loaded': 0.0, 'configs': None}
+_migrated_commodity_configs = False
+# set in redis once the legacy '<commodity>_config' keys have been migrated, so it only happens once
+COMMODITY_CONFIG_MIGRATED_KEY = 'commodity_config_migrated'
+# what the commodity in a legacy '<commodity>_config' key looks like
+LEGACY_COMMODITY_RE = re.compile(r'^[A-Za-z0-9]+$')
+
+
+def _legacy_commodity_config(key, raw):
+    """
+    :return: The commodity of a legacy '<commodity>_config' key, or None if the key or value doesn't look like one.
+    """
+    comm = key[:-len('_config')]
+    if LEGACY_COMMODITY_RE.match(comm) is None:
+        return None
+    try:
+        detail = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(detail, dict) or len(detail) == 0 or not set(detail) <= set(COMMODITY_CONFIG_DEFAULTS):
+        return None
+    return comm
+
+
+def _migrate_commodity_configs(red):
+    """
+    Move the legacy '<commodity>_config' string keys into the commodity config hash.
+    Only keys named like a commodity, holding a JSON config, are moved. Anything else is left where it is.
+    Runs once, then sets COMMODITY_CONFIG_MIGRATED_KEY.
+    """
+    global _migrated_commodity_configs
+    _migrated_commodity_configs = True
+    if red.get(COMMODITY_CONFIG_MIGRATED_KEY) is not None:
+        return
+    for key in red.scan_iter(match='*_config'):
+        if red.type(key) not in ('string', b'string'):
+            continue
+        raw = red.get(key)
+        comm = _legacy_commodity_config(key, raw) if raw is not None else None
+        if comm is None:
+            continue
+        red.hsetnx(COMMODITY_CONFIG_KEY, comm, raw)
+        red.delete(key)
+    red.set(COMMODITY_CONFIG_MIGRATED_KEY, 1)
+
+
+def invalidate_commodity_configs():
+    """
+    Discard the in process commodity configs, so the next read comes from redis.
+    """
+    global _commodity_configs
+    _commodity_configs = {'loaded': 0.0, 'configs': None}
+
+
 def set_commodity_config(commodity, weight=1.0, cfloor=0.0, ctarget=0.0, cceil=0.0):
     detail = {'weight': weight, 'floor': cfloor, 'target': ctarget, 'ceil': cceil}
-    red.set('%s_config' % commodity, json.dumps(detail))
+    red = get_redis()
+    if not _migrated_commodity_configs:
+        _migrate_commodity_configs(red)
+    red.hset(COMMODITY_CONFIG_KEY, commodity, json.dumps(detail))
+    invalidate_commodity_configs()
 
 
-def get_commodity_config(commodity):
-    comm_cfg = red.get('%s_config' % commodity)
-    detail = {'weight': 1.0, 'floor': 0.0, 'target': 0.0, 'ceil': 0.0}
+def get_commodity_configs(commodities=None):
+    """
+    Get the config of many commodities at once. All configs are loaded with one HGETALL,
+    and cached in process for COMMODITY_CONFIG_TTL seconds.
 
-    def merge_details(default, tomerge):
-        for key in tomerge:
-            default[key] = tomerge[key]
-        return default
+    :param commodities: The commodities to get configs for. (optional, defaults to all configured commodities)
+    :return: A dict of commodity -> config
+    """
+    global _commodity_configs
+    now = time.time()
+    if _commodity_configs['configs'] is None or now - _commodity_configs['loaded'] >= COMMODITY_CONFIG_TTL:
+        red = get_redis()
+        if not _migrated_commodity_configs:
+            _migrate_commodity_configs(red)
+        configs = {}
+        for comm, raw in red.hgetall(COMMODITY_CONFIG_KEY).items():
+            configs[comm] = dict(COMMODITY_CONFIG_DEFAULTS)
+            try:
+                configs[comm].update(json.loads(raw))
+            except ValueError:
+                pass  # a malformed config falls back to the defaults
+        _commodity_configs = {'loaded': now, 'configs': configs}
+    configs = _commodity_configs['configs']
+    if commodities is None:
+        commodities = configs.keys()
+    return dict((comm, dict(configs.get(comm, COMMODITY_CONFIG_DEFAULTS))) for comm in commodities)
 
-    if comm_cfg is not None:
-        return merge_details(detail, json.loads(comm_cfg))
-    else:
-        return detail
+
+def get_commodity_config(commodity):
+    return get_commodity_configs([commodity])[commodity]
 
 
 def get_ticker(exchange=None, market="BTC_USD", red=None):
+    return get_tickers([(exchange, market)], red=red)[(exchange, market)]
+
+
+def get_tickers(pairs, red=None):
+    """
+    Get many tickers at once.
+    Preferred exchanges are looked up in one redis pipeline, then every ticker key needed,
+    including the X_BTC and BTC_USD legs of synthetic X_USD tickers, is read with one MGET.
+
+    :param pairs: (exchange, market) tuples. Use None for the exchange to use the market's preferred exchange.
+    :return: A dict of (exchange, market) -> Ticker, or None if the ticker is unavailable.
+    :rtype: dict
+    """
     if red is None:
-        red = setup_redis()
+        red = get_redis()
+    pairs = list(pairs)
+    route = set()
+    for exchange, market in pairs:
+        base, quote = market.split("_")
+        if exchange is None:
+            route.add(market)
+        if quote == "USD":
+            route.update(["%s_BTC" % base, "BTC_USD"])
+    prefs = get_preferred_exchanges(route, red=red) if len(route) > 0 else {}
 
-    def safe_get_ticker(exch, market, red):
-        gt = red.get('%s_%s_ticker' % (exch, market))
+    def legs(exchange, market):
         base, quote = market.split("_")
-        if gt is not None:
-            return em.Ticker.from_json(gt)
-        elif quote == "USD":
-            t1mark = "%s_BTC" % base
-            t1ex = get_preferred_exchange(t1mark)
-            t1r = red.get('%s_%s_ticker' % (t1ex, t1mark))
-            if t1r is None:
-                return
-            t1 = em.Ticker.from_json(t1r)
-            t2 = get_ticker(market='BTC_USD', red=red)
-            if t2 is None:
-                return
-            return multiply_tickers(t1, t2)
+        direct = (exchange.lower() if exchange is not None else prefs.get(market), market)
+        if quote != "USD":
+            return direct, None, None
+        return direct, (prefs.get("%s_BTC" % base), "%s_BTC" % base), (prefs.get("BTC_USD"), "BTC_USD")
+
+    keys = set()
+    for pair in pairs:
+        for leg in legs(*pair):
+            if leg is not None and leg[0] is not None:
+                keys.add('%s_%s_ticker' % leg)
+    keys = list(keys)
+    raw = dict(zip(keys, red.mget(keys))) if len(keys) > 0 else {}
+    parsed = {}
+
+    def parse(leg):
+        if leg is None or leg[0] is None:
+            return
+        key = '%s_%s_ticker' % leg
+        if key not in parsed:
+            parsed[key] = decode_ticker(raw[key]) if raw.get(key) is not None else None
+        return parsed[key]
+
+    resp = {}
+    for pair in pairs:
+        direct, t1leg, t2leg = legs(*pair)
+        ticker = parse(direct)
+        if ticker is None and t1leg is not None:
+            t1 = parse(t1leg)
+            t2 = parse(t2leg)
+            if t1 is not None and t2 is not None:
+                ticker = multiply_tickers(t1, t2)
+        resp[pair] = ticker
+    return resp
 
-    if exchange is None:
-        exch = get_preferred_exchange(market)
-        return safe_get_ticker(exch, market, red)
-    else:
-        return safe_get_ticker(exchange.lower(), market, red)
+
+TICKER_CHANNEL = 'ticker:%s:%s'
+# seconds a TickerSubscriber waits before reconnecting after losing its redis connection
+TICKER_RECONNECT_DELAY = 1.0
+
+
+def publish_ticker(ticker, red=None, binary=False):
+    """
+    Save a ticker to its redis key, and publish it on its exchange and market's channel, in one round trip.
+
+    :param Ticker ticker: The ticker to save.
+    :param bool binary: Use the compact binary ticker encoding instead of JSON.
+    """
+    if red is None:
+        red = get_redis()
+    exchange = ticker.exchange.lower()
+    jtick = encode_ticker(ticker, binary=binary)
+    pipe = red.pipeline()
+    pipe.set('%s_%s_ticker' % (exchange, ticker.market), jtick)
+    pipe.publish(TICKER_CHANNEL % (exchange, ticker.market), jtick)
+    pipe.execute()
+
+
+class TickerSubscriber(object):
+    """
+    An in memory table of the latest tickers, kept up to date by redis pub/sub instead of polling.
+    The table is warmed from the ticker keys when started, then updated by a background thread
+    as plugins publish new tickers. Bad messages are skipped, and a lost connection is reconnected and rewarmed.
+    Consumers should fall back to get_tickers while is_alive() is False.
+    """
+
+    def __init__(self, exchanges=None, red=None):
+        """
+        :param list exchanges: The exchanges to follow. (optional, defaults to all)
+        """
+        self.red = red if red is not None else get_redis()
+        self.exchanges = [exchange.lower() for exchange in exchanges] if exchanges is not None else None
+        self.tickers = {}
+        self.callbacks = []
+        self._pubsub = None
+        self._thread = None
+        self._stopped = False
+        self._connected = False
+        # time.time() of the last message received, or None before the first
+        self.last_message = None
+
+    def add_callback(self, callback):
+        """
+        :param callback: Called with (exchange, market, ticker) from the listener thread, for every new ticker.
+        """
+        self.callbacks.append(callback)
+
+    def get_ticker(self, exchange, market):
+        """
+        :return: The latest Ticker, or None if none has been seen.
+        """
+        return self.tickers.get((exchange.lower(), market))
+
+    def _update(self, exchange, market, ticker):
+        current = self.tickers.get((exchange, market))
+        if current is not None and ticker.time < current.time:
+            return
+        self.tickers[(exchange, market)] = ticker
+        for callback in self.callbacks:
+            callback(exchange, market, ticker)
+
+    def is_alive(self):
+        """
+        :return: True if the table is being kept up to date.
+        """
+        return self._connected and self._thread is not None and self._thread.is_alive()
+
+    def _subscribe(self):
+        patterns = [TICKER_CHANNEL % (exchange, '*') for exchange in self.exchanges or ['*']]
+        self._pubsub = self.red.pubsub()
+        self._pubsub.psubscribe(*patterns)
+
+    def _warm(self):
+        pairs = get_exchange_markets(self.exchanges, red=self.red)
+        for (exchange, market), ticker in get_tickers(pairs, red=self.red).items():
+            if ticker is not None:
+                self._update(exchange, market, ticker)
+
+    def _handle(self, message):
+        self.last_message = time.time()
+        if message['type'] != 'pmessage':
+            return
+        try:
+            prefix, exchange, market = message['channel'].split(":")
+            self._update(exchange, market, decode_ticker(message['data']))
+        except Exception as e:
+            print "skipped ticker message on %s: %s" % (message['channel'], e)
+
+    def _listen(self):
+        while not self._stopped:
+            try:
+                if not self._connected:
+                    self._pubsub.close()
+                    self._subscribe()
+                    self._warm()
+                    self._connected = True
+                for message in self._pubsub.listen():
+                    self._handle(message)
+                return
+            except redis.ConnectionError as e:
+                self._connected = False
+                if self._stopped:
+                    return
+                print "ticker subscriber lost its connection, reconnecting: %s" % e
+                time.sleep(TICKER_RECONNECT_DELAY)
+
+    def start(self):
+        """
+        Subscribe, then load the current tickers, so no update is missed in between.
+        Following all exchanges, the tickers of the running exchange workers are loaded.
+        """
+        self._stopped = False
+        self._subscribe()
+        self._connected = True
+        self._thread = threading.Thread(target=self._listen, name='ticker-subscriber')
+        self._thread.daemon = True
+        self._thread.start()
+        self._warm()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        if self._pubsub is not None:
+            try:
+                self._pubsub.punsubscribe()
+            except redis.ConnectionError:
+                pass
+            self._thread.join(1.0)
+            self._pubsub.close()
+            self._pubsub = None
+        self._connected = False
 
 
 def submit_order(exchange, oid, expire=None):
@@ -395,6 +1074,17 @@ def submit_order(exchange, oid, expire=None):
     publish(exchange, 'create_order', data)
 
 
+def submit_orders(exchange, oids, expire=None):
+    """
+    Submit many orders to an exchange manager with one message.
+    """
+    assert all(isinstance(oid, int) for oid in oids)
+    data = {'oids': list(oids)}
+    if expire is not None:
+        data['expire'] = expire
+    publish(exchange, 'create_orders', data)
+
+
 def cancel_orders(exchange, market=None, oid=None, side=None, order_id=None):
     data = {}
     if order_id is not None:
@@ -422,7 +1112,7 @@ def sync_ticker(exchange=None, market=None):
         else:
             publish(ex, 'sync_ticker', {'market': mark})
     if exchange is None:
-        for exch in get_running_workers(EXCHANGES, red=red):
+        for exch in get_running_workers(EXCHANGES, red=get_redis()):
             sync_exchange_ticker(exch, market)
     else:
         sync_exchange_ticker(exchange, market)
@@ -463,9 +1153,65 @@ DB helpers
 """
 
 
-def get_trades(exchange=None, market=None, tid=None, trade_id=None, session=None):
-    if session is None:
-        session, eng = create_session_engine()
+# rows fetched per keyset page by the iter_* helpers
+PAGE_SIZE = 1000
+
+
+def _filter_time(query, column, since=None, until=None):
+    if since is not None:
+        query = query.filter(column >= since)
+    if until is not None:
+        query = query.filter(column < until)
+    return query
+
+
+def keyset_page(query, columns, size, last=None):
+    """
+    Build the query for one keyset page.
+
+    :param list columns: The unique, ordered columns to paginate by.
+    :param int size: The number of rows in the page.
+    :param list last: The column values of the last row of the previous page, or None for the first page.
+    """
+    if last is not None:
+        query = query.filter(sa.tuple_(*columns) > sa.tuple_(*last))
+    return query.order_by(*columns).limit(size)
+
+
+def _iter_keyset(query, columns, limit=None, page_size=None):
+    """
+    Iterate over a query one page at a time, using keyset pagination on the given columns.
+    Each page starts after the last row of the previous one, so deep pages cost no more than the first,
+    and no more than one page is held in memory.
+
+    :param query: The query to iterate over.
+    :param list columns: The unique, ordered columns to paginate by. i.e. [id] or [time, id]
+    :param int limit: The maximum number of rows to return. (optional)
+    :param int page_size: The number of rows to fetch per page. (optional)
+    """
+    page_size = page_size or PAGE_SIZE
+    last = None
+    count = 0
+    while limit is None or count < limit:
+        size = page_size if limit is None else min(page_size, limit - count)
+        rows = keyset_page(query, columns, size, last).all()
+        for row in rows:
+            yield row
+        count += len(rows)
+        if len(rows) < size:
+            return
+        last = [getattr(rows[-1], column.key) for column in columns]
+
+
+def _keyset_columns(model, timecol, order_by):
+    if order_by == 'time':
+        return [timecol, model.id]
+    elif order_by == 'id':
+        return [model.id]
+    raise ValueError("unable to order by %s" % order_by)
+
+
+def trade_query(session, exchange=None, market=None, tid=None, trade_id=None, since=None, until=None):
     query = session.query(em.Trade)
     if trade_id is not None:
         trade_id = trade_id if "|" in str(trade_id) else '%s|%s' % (exchange.lower(), trade_id)
@@ -473,43 +1219,95 @@ def get_trades(exchange=None, market=None, tid=None, trade_id=None, session=None
     query = filter_query_by_attr(query, em.Trade, 'exchange', exchange)
     query = filter_query_by_attr(query, em.Trade, 'market', market)
     query = filter_query_by_attr(query, em.Trade, 'id', tid)
-    resp = []
-    for trade in query:
-        resp.append(trade)
-    return resp
+    return _filter_time(query, em.Trade.time, since, until)
+
+
+def iter_trades(exchange=None, market=None, tid=None, trade_id=None, session=None, since=None, until=None,
+                limit=None, order_by='id'):
+    """
+    Iterate over trades, one keyset page at a time.
+
+    :param datetime since: Only trades at or after this time. (optional)
+    :param datetime until: Only trades before this time. (optional)
+    :param int limit: The maximum number of trades. (optional)
+    :param str order_by: 'id' or 'time'
+    """
+    with session_scope(session) as session:
+        query = trade_query(session, exchange, market, tid, trade_id, since, until)
+        for row in _iter_keyset(query, _keyset_columns(em.Trade, em.Trade.time, order_by), limit=limit):
+            yield row
 
 
-def get_credits(exchange=None, address=None, currency=None, ref_id=None, session=None):
-    if session is None:
-        session, eng = create_session_engine()
+def get_trades(exchange=None, market=None, tid=None, trade_id=None, session=None, since=None, until=None,
+               limit=None, order_by='id'):
+    return list(iter_trades(exchange, market, tid, trade_id, session=session, since=since, until=until,
+                            limit=limit, order_by=order_by))
+
+
+def credit_query(session, exchange=None, address=None, currency=None, ref_id=None, since=None, until=None):
     query = session.query(wm.Credit)
     query = filter_query_by_attr(query, wm.Credit, 'ref_id', ref_id)
     query = filter_query_by_attr(query, wm.Credit, 'network', exchange)
     query = filter_query_by_attr(query, wm.Credit, 'address', address)
     query = filter_query_by_attr(query, wm.Credit, 'currency', currency)
-    resp = []
-    for cred in query:
-        resp.append(cred)
-    return resp
+    return _filter_time(query, wm.Credit.time, since, until)
 
 
-def get_debits(exchange=None, address=None, currency=None, ref_id=None, session=None):
-    if session is None:
-        session, eng = create_session_engine()
+def iter_credits(exchange=None, address=None, currency=None, ref_id=None, session=None, since=None, until=None,
+                 limit=None, order_by='id'):
+    """
+    Iterate over credits, one keyset page at a time.
+
+    :param datetime since: Only credits at or after this time. (optional)
+    :param datetime until: Only credits before this time. (optional)
+    :param int limit: The maximum number of credits. (optional)
+    :param str order_by: 'id' or 'time'
+    """
+    with session_scope(session) as session:
+        query = credit_query(session, exchange, address, currency, ref_id, since, until)
+        for row in _iter_keyset(query, _keyset_columns(wm.Credit, wm.Credit.time, order_by), limit=limit):
+            yield row
+
+
+def get_credits(exchange=None, address=None, currency=None, ref_id=None, session=None, since=None, until=None,
+                limit=None, order_by='id'):
+    return list(iter_credits(exchange, address, currency, ref_id, session=session, since=since, until=until,
+                             limit=limit, order_by=order_by))
+
+
+def debit_query(session, exchange=None, address=None, currency=None, ref_id=None, since=None, until=None):
     query = session.query(wm.Debit)
     query = filter_query_by_attr(query, wm.Debit, 'ref_id', ref_id)
     query = filter_query_by_attr(query, wm.Debit, 'network', exchange)
     query = filter_query_by_attr(query, wm.Debit, 'address', address)
     query = filter_query_by_attr(query, wm.Debit, 'currency', currency)
-    resp = []
-    for deb in query:
-        resp.append(deb)
-    return resp
+    return _filter_time(query, wm.Debit.time, since, until)
+
+
+def iter_debits(exchange=None, address=None, currency=None, ref_id=None, session=None, since=None, until=None,
+                limit=None, order_by='id'):
+    """
+    Iterate over debits, one keyset page at a time.
+
+    :param datetime since: Only debits at or after this time. (optional)
+    :param datetime until: Only debits before this time. (optional)
+    :param int limit: The maximum number of debits. (optional)
+    :param str order_by: 'id' or 'time'
+    """
+    with session_scope(session) as session:
+        query = debit_query(session, exchange, address, currency, ref_id, since, until)
+        for row in _iter_keyset(query, _keyset_columns(wm.Debit, wm.Debit.time, order_by), limit=limit):
+            yield row
+
 
+def get_debits(exchange=None, address=None, currency=None, ref_id=None, session=None, since=None, until=None,
+               limit=None, order_by='id'):
+    return list(iter_debits(exchange, address, currency, ref_id, session=session, since=since, until=until,
+                            limit=limit, order_by=order_by))
 
-def get_orders(exchange=None, market=None, side=None, oid=None, order_id=None, state=None, session=None):
-    if session is None:
-        session, eng = create_session_engine()
+
+def order_query(session, exchange=None, market=None, side=None, oid=None, order_id=None, state=None, since=None,
+                until=None):
     query = session.query(em.LimitOrder)
     if order_id is not None:
         order_id = order_id if "|" in str(order_id) else '%s|%s' % (exchange.lower(), order_id)
@@ -519,38 +1317,96 @@ def get_orders(exchange=None, market=None, side=None, oid=None, order_id=None, s
     query = filter_query_by_attr(query, em.LimitOrder, 'exchange', exchange)
     query = filter_query_by_attr(query, em.LimitOrder, 'id', oid)
     query = filter_query_by_attr(query, em.LimitOrder, 'state', state)
-    resp = []
-    for order in query:
-        resp.append(order)
-    return resp
+    return _filter_time(query, em.LimitOrder.create_time, since, until)
+
+
+def iter_orders(exchange=None, market=None, side=None, oid=None, order_id=None, state=None, session=None,
+                since=None, until=None, limit=None, order_by='id'):
+    """
+    Iterate over orders, one keyset page at a time.
+
+    :param datetime since: Only orders created at or after this time. (optional)
+    :param datetime until: Only orders created before this time. (optional)
+    :param int limit: The maximum number of orders. (optional)
+    :param str order_by: 'id' or 'time'
+    """
+    with session_scope(session) as session:
+        query = order_query(session, exchange, market, side, oid, order_id, state, since, until)
+        columns = _keyset_columns(em.LimitOrder, em.LimitOrder.create_time, order_by)
+        for row in _iter_keyset(query, columns, limit=limit):
+            yield row
+
+
+def get_orders(exchange=None, market=None, side=None, oid=None, order_id=None, state=None, session=None,
+               since=None, until=None, limit=None, order_by='id'):
+    return list(iter_orders(exchange, market, side, oid, order_id, state, session=session, since=since,
+                            until=until, limit=limit, order_by=order_by))
 
 
 def get_order_by_order_id(order_id, exchange, session=None):
-    if session is None:
-        session = ses
     if "|" in order_id:
         order_id = order_id.split("|")[1]
-    order = session.query(em.LimitOrder)\
-        .filter(em.LimitOrder.order_id == "%s|%s" % (exchange.lower(), order_id)).one_or_none()
-    if order is None:
-        order = session.query(em.LimitOrder).filter(
-            em.LimitOrder.order_id == "tmp|%s" % order_id).one_or_none()
+    with session_scope(session) as session:
+        order = session.query(em.LimitOrder)\
+            .filter(em.LimitOrder.order_id == "%s|%s" % (exchange.lower(), order_id)).one_or_none()
+        if order is None:
+            order = session.query(em.LimitOrder).filter(
+                em.LimitOrder.order_id == "tmp|%s" % order_id).one_or_none()
     return order
 
 
-def get_balances(exchange=None, currency=None, session=None):
-    if session is None:
-        session, eng = create_session_engine()
-    query = session.query(wm.Balance)
+def balance_query(session, exchange=None, currency=None, by_exchange=False):
+    """
+    Build the query summing balances by currency, and by exchange manager username if by_exchange.
+    """
+    columns = [wm.Balance.currency, sa.func.sum(wm.Balance.total, type_=sa.Float),
+               sa.func.sum(wm.Balance.available, type_=sa.Float)]
+    groups = [wm.Balance.currency]
+    if by_exchange:
+        columns.insert(0, um.User.username)
+        groups.insert(0, um.User.username)
+    query = session.query(*columns)
+    if by_exchange or exchange is not None:
+        query = query.join(um.User, um.User.id == wm.Balance.user_id)
     if currency is not None:
         query = filter_query_by_attr(query, wm.Balance, 'currency', currency)
     if exchange is not None:
-        query = query.join(um.User).filter(um.User.username == "%sManager" % exchange.lower())
+        query = query.filter(um.User.username == "%sManager" % exchange.lower())
+    return query.group_by(*groups)
+
+
+def get_balances(exchange=None, currency=None, session=None, by_exchange=False):
+    """
+    Get the total and available balances, summed by currency in the database.
+
+    :param str exchange: The exchange to filter for. (optional)
+    :param str currency: The currency to filter for. (optional)
+    :param session: The sqlalchemy session.
+    :param bool by_exchange: Also return a breakdown by exchange, from the same query. (optional)
+    :return: The total and available Balances. If by_exchange is True, a third item is added:
+        a dict of exchange -> (total, available).
+    :rtype: tuple
+    """
+    with session_scope(session) as session:
+        rows = balance_query(session, exchange, currency, by_exchange).all()
     total = Balance()
     available = Balance()
-    for bal in query:
-        total = total + bal.total
-        available = available + bal.available
+    breakdown = {}
+    for row in rows:
+        if by_exchange:
+            username, curr, rtotal, ravailable = row
+        else:
+            curr, rtotal, ravailable = row
+        rtotal = Amount("{0:.8f} {1}".format(rtotal or 0, curr))
+        ravailable = Amount("{0:.8f} {1}".format(ravailable or 0, curr))
+        total = total + rtotal
+        available = available + ravailable
+        if by_exchange:
+            ex = username[:-len("Manager")].lower() if username.endswith("Manager") else username
+            extotal, exavailable = breakdown.get(ex, (Balance(), Balance()))
+            breakdown[ex] = (extotal + rtotal, exavailable + ravailable)
+    if by_exchange:
+        return total, available, breakdown
     return total, available
 
 
@@ -569,71 +1425,398 @@ def create_order(exchange, price, amount, market, side, session, submit=True, ex
     return order
 
 
+def create_orders(exchange, orders, session, submit=True, expire=None):
+    """
+    Create many orders in one transaction, and submit them to the exchange manager with one message.
+
+    :param list orders: (price, amount, market, side) tuples, or dicts with those keys.
+    :return: The new LimitOrders, or an empty list if they could not be saved.
+    :rtype: list
+    """
+    new = []
+    for order in orders:
+        order = _as_kwargs(order, ORDER_FIELDS)
+        new.append(em.LimitOrder(order['price'], order['amount'], order['market'], order['side'], exchange.lower()))
+    if len(new) == 0:
+        return new
+    session.add_all(new)
+    try:
+        session.commit()
+    except Exception as e:
+        print e
+        session.rollback()
+        session.flush()
+        return []
+    for order in new:
+        order.load_commodities()
+    if submit:
+        submit_orders(exchange, [order.id for order in new], expire=expire)
+    return new
+
+
+def reconcile_ladder(exchange, market, side, ladder, session, submit=True, expire=None,
+                     price_tolerance=PRICE_TOLERANCE, size_tolerance=SIZE_TOLERANCE):
+    """
+    Move the open orders on one side of a market to a desired ladder, sending only the differences.
+    Orders already within tolerance of a level are left alone. Orders that are stale, or at the right price
+    with the wrong size, are canceled. Missing levels are created with one create_orders call.
+    The replacements for amended orders are only created when the cancels are sent, so an unsubmitted
+    run never leaves an order and its replacement side by side.
+
+    :param list ladder: (price, amount) tuples for the desired orders.
+    :param bool submit: Send the cancels and creates to the exchange manager.
+    :return: The reconcile_orders result, plus 'created', the new LimitOrders.
+    :rtype: dict
+    """
+    current = []
+    for state in ('pending', 'open'):
+        current.extend(iter_orders(exchange.lower(), market, side, state=state, session=session))
+    diff = reconcile_orders(ladder, current, price_tolerance=price_tolerance, size_tolerance=size_tolerance)
+    levels = list(diff['create'])
+    if submit:
+        for order in diff['cancel'] + [order for order, level in diff['amend']]:
+            cancel_orders(exchange, oid=order.id)
+        levels.extend([level for order, level in diff['amend']])
+    diff['created'] = create_orders(exchange, [(price, amount, market, side) for price, amount in levels], session,
+                                    submit=submit, expire=expire)
+    return diff
+
+
 """
 Math helpers
 """
 
 
-def get_usd_value(amount, price=None):
+# seconds a price graph is reused before it is rebuilt from fresh tickers
+PRICE_GRAPH_TTL = 1.0
+# exchanges -> (built time, PriceGraph)
+_price_graphs = {}
+
+
+def get_price_graph(exchanges=None, red=None):
+    """
+    Get a PriceGraph of every active market's ticker on the given exchanges, read with one MGET.
+    Graphs, and the rates found in them, are reused for PRICE_GRAPH_TTL seconds.
+
+    :param list exchanges: The exchanges to include. (optional, defaults to the running exchange workers)
+    """
+    if exchanges is None:
+        exchanges = get_running_workers(EXCHANGES, red=red if red is not None else get_redis())
+    exchanges = tuple(exchanges)
+    now = time.time()
+    built, graph = _price_graphs.get(exchanges, (0.0, None))
+    if graph is None or now - built >= PRICE_GRAPH_TTL:
+        pairs = get_exchange_markets(exchanges, red=red)
+        graph = PriceGraph(get_tickers(pairs, red=red).values())
+        _price_graphs[exchanges] = (now, graph)
+    return graph
+
+
+def get_rate(base, quote, exchanges=None, red=None):
+    """
+    Get the rate to convert base into quote, through any chain of live markets.
+
+    :return: The price of one base, as an Amount of quote, or None if there is no path.
+    """
+    rate = get_price_graph(exchanges, red=red).get_rate(base, quote)
+    if rate is None:
+        return None
+    return Amount("{0:.8f} {1}".format(rate, quote))
+
+
+class PriceSnapshot(object):
+    """
+    A point in time view of prices. The tickers needed are read together when the snapshot is taken,
+    so every valuation made with it comes from the same tick. Indexes and USD prices are memoized.
+    Tickers not loaded up front are read on first use.
+    """
+
+    def __init__(self, commodities=(), pairs=(), exchanges=None, red=None):
+        """
+        :param commodities: Commodities whose USD price will be needed. (optional)
+        :param pairs: Extra (exchange, market) tickers that will be needed. (optional)
+        :param list exchanges: Exchanges whose active markets to load, and to build a price graph from.
+                               Unconfigured exchanges are skipped. (optional, defaults to the running exchange workers)
+        """
+        self.red = red if red is not None else get_redis()
+        if exchanges is None:
+            exchanges = get_running_workers(EXCHANGES, red=self.red)
+        self.exchanges = tuple(exchanges)
+        pairs = [(exchange.lower() if exchange is not None else None, market) for exchange, market in pairs]
+        pairs.extend(get_exchange_markets(self.exchanges, red=self.red))
+        commodities = set(commodities)
+        commodities.update([market.split("_")[0] for exchange, market in pairs])
+        pairs.extend([(None, "%s_USD" % comm) for comm in commodities if comm != 'USD'])
+        self.tickers = get_tickers(set(pairs), red=self.red)
+        self._graph = None
+        self._index = {}
+        self._usd = {'USD': Amount("1 USD")}
+
+    def get_ticker(self, exchange, market):
+        """
+        :param str exchange: The exchange, or None for the market's preferred exchange.
+        :return: The Ticker, or None if unavailable.
+        """
+        pair = (exchange.lower() if exchange is not None else None, market)
+        if pair not in self.tickers:
+            self.tickers.update(get_tickers([pair], red=self.red))
+        return self.tickers[pair]
+
+    def get_index(self, exchange, market):
+        """
+        :return: The ticker's calculate_index(), or None if the ticker is unavailable.
+        """
+        key = (exchange, market)
+        if key not in self._index:
+            ticker = self.get_ticker(exchange, market)
+            self._index[key] = ticker.calculate_index() if ticker is not None else None
+        return self._index[key]
+
+    @property
+    def graph(self):
+        """
+        A PriceGraph of the exchange tickers in this snapshot.
+        """
+        if self._graph is None:
+            self._graph = PriceGraph([tick for (exchange, market), tick in self.tickers.items()
+                                      if exchange is not None])
+        return self._graph
+
+    def get_usd_price(self, commodity):
+        """
+        :return: The USD price of one unit of commodity, or None if it can't be priced.
+        :rtype: Amount
+        """
+        if commodity not in self._usd:
+            price = self.get_index(None, "%s_USD" % commodity)
+            if price is None:
+                rate = self.graph.get_rate(commodity, 'USD')
+                price = Amount("{0:.8f} USD".format(rate)) if rate is not None else None
+            self._usd[commodity] = price
+        return self._usd[commodity]
+
+
+def get_usd_value(amount, price=None, snapshot=None):
+    """
+    :param Amount amount: The Amount to value.
+    :param Amount price: The USD price of the amount's commodity, if already known. (optional)
+    :param PriceSnapshot snapshot: A snapshot to get the price from. (optional)
+    """
     if not isinstance(amount, Amount):
         raise TypeError("requires an Amount argument")
     comm = str(amount.commodity)
     if comm == 'USD':
         return amount
     elif comm != '':
-        if price is None:
-            ticker = get_ticker(market="%s_USD" % comm, red=red)
-            if ticker is None:
+        if price is None and snapshot is not None:
+            price = snapshot.get_usd_price(comm)
+            if price is None:
                 raise TypeError("inactive commodity %s" % comm)
-            else:
+        elif price is None:
+            ticker = get_ticker(market="%s_USD" % comm)
+            if ticker is not None:
                 price = ticker.calculate_index()
+            else:
+                price = get_rate(comm, 'USD')
+                if price is None:
+                    raise TypeError("inactive commodity %s" % comm)
         return Amount("%s USD" % amount.number()) * price
 
 
-def get_weighted_usd_volume(ticker):
+def get_weighted_usd_volume(ticker, usd_price=None, snapshot=None):
+    """
+    :param ticker: The Ticker to get the volume of.
+    :param Amount usd_price: The USD price of the ticker's base commodity, if already known. (optional)
+    :param PriceSnapshot snapshot: A snapshot to get prices from. (optional)
+    """
     if isinstance(ticker, dict):
         ticker = em.Ticker.from_dict(ticker)
     if isinstance(ticker, str):
-        ticker = em.Ticker.from_json(ticker)
+        ticker = decode_ticker(ticker)
     base = str(ticker.volume.commodity)
     quote = str(ticker.last.commodity)
-    base_comm_cfg = get_commodity_config(base)
-    quote_comm_cfg = get_commodity_config(quote)
-    weight = Amount("%s USD" % base_comm_cfg['weight']) * Amount("%s USD" % quote_comm_cfg['weight'])
+    configs = get_commodity_configs([base, quote])
+    weight = Amount("%s USD" % configs[base]['weight']) * Amount("%s USD" % configs[quote]['weight'])
     if 'USD' in base:  # flexible for USDT, but is this a potential conflict?
         return weight * Amount("%s USD" % ticker.volume.number())
     elif 'USD' in quote:  # flexible for USDT, but is this a potential conflict?
-        return weight * Amount("%s USD" % ticker.volume.number()) * ticker.calculate_index()
+        index = snapshot.get_index(ticker.exchange, ticker.market) if snapshot is not None else None
+        return weight * Amount("%s USD" % ticker.volume.number()) * (index or ticker.calculate_index())
     else:
-        usdprice = get_usd_value(Amount("1 %s" % base))
+        usdprice = get_usd_value(Amount("1 %s" % base), price=usd_price, snapshot=snapshot)
         return Amount("%s USD" % usdprice.number()) * Amount("%s USD" % ticker.volume.number()) * weight
 
 
-def get_market_vol_shares(exchange, c=None):
-    vols = {'total': Amount("0 USD")}
-
-    for market in get_active_markets(exchange):
-        if c is None:
-            tick = get_ticker(exchange, market.upper())
-            vols[market] = {'USD_volume': get_weighted_usd_volume(tick), 'ticker': tick}
-            vols['total'] += vols[market]['USD_volume']
-        elif c.upper() in market.upper():
-            tick = get_ticker(exchange, market.upper())
-            # pair = market.split("_")
-            uvol = get_weighted_usd_volume(tick)
-            vols[market] = {'USD_volume': uvol, 'ticker': tick}
-            vols['total'] += vols[market]['USD_volume']
-    for market in vols:
-        if market == 'total':
+def _usd_amount(value):
+    return Amount("{0:.8f} USD".format(value))
+
+
+def _market_usd_volumes(exchange, markets, snapshot=None):
+    """
+    Compute the weighted USD volume of many markets as floats, from one batch of tickers and commodity configs.
+
+    :return: A dict of market -> (weighted USD volume, ticker), and a list of markets that could not be priced.
+    """
+    if snapshot is None:
+        snapshot = PriceSnapshot(pairs=[(exchange, market) for market in markets], exchanges=[exchange])
+    configs = get_commodity_configs(set(comm for market in markets for comm in market.split("_")))
+    volumes = {}
+    unpriced = []
+    for market in markets:
+        tick = snapshot.get_ticker(exchange, market)
+        base, quote = market.split("_")
+        weight = float(configs[base]['weight']) * float(configs[quote]['weight'])
+        if tick is None:
+            unpriced.append(market)
             continue
-        if vols['total'] > 0:
-            vols[market]['vol_share'] = (vols[market]['USD_volume'] / vols['total']).to_double()
+        volume = tick.volume.to_double()
+        if 'USD' in base:  # flexible for USDT, but is this a potential conflict?
+            price = 1.0
+        elif 'USD' in quote:
+            price = snapshot.get_index(exchange, market).to_double()
         else:
-            vols[market]['vol_share'] = 0
+            usd_price = snapshot.get_usd_price(base)
+            if usd_price is None:
+                unpriced.append(market)
+                continue
+            price = usd_price.to_double()
+        volumes[market] = (weight * volume * price, tick)
+    return volumes, unpriced
+
+
+def _vol_shares(volumes, markets):
+    total = sum(volumes[market][0] for market in markets)
+    vols = {'total': _usd_amount(total)}
+    for market in markets:
+        volume, tick = volumes[market]
+        vols[market] = {'USD_volume': _usd_amount(volume), 'ticker': tick,
+                        'vol_share': volume / total if total > 0 else 0}
     return vols
 
 
-def make_ledger(exchange=None, session=ses):
+def get_market_vol_shares(exchange, c=None, snapshot=None):
+    markets = [market.upper() for market in get_active_markets(exchange) if c is None or c.upper() in market.upper()]
+    volumes, unpriced = _market_usd_volumes(exchange, markets, snapshot=snapshot)
+    if len(unpriced) > 0:
+        raise TypeError("inactive market %s" % unpriced[0])
+    return _vol_shares(volumes, markets)
+
+
+def get_all_market_vol_shares(exchange, snapshot=None):
+    """
+    Get the market volume shares of every commodity traded on an exchange at once.
+    All tickers and commodity configs are read in one batch, and shares are computed in floats,
+    converting to Amounts only for the results.
+    Markets that can't be priced in USD are left out of their commodities' shares,
+    and commodities with no market that can be priced are left out entirely.
+
+    :param str exchange: The exchange to get market volume shares for.
+    :param PriceSnapshot snapshot: A snapshot to get prices from. (optional)
+    :return: A dict of commodity -> the get_market_vol_shares result for that commodity.
+    """
+    markets = [market.upper() for market in get_active_markets(exchange)]
+    volumes, unpriced = _market_usd_volumes(exchange, markets, snapshot=snapshot)
+    shares = {}
+    for comm in set(comm for market in markets for comm in market.split("_")):
+        priced = [market for market in markets if comm in market.split("_") and market in volumes]
+        if len(priced) > 0:
+            shares[comm] = _vol_shares(volumes, priced)
+    return shares
+
+
+LEDGER_PAGE_SIZE = 1000
+# ledger entry kind -> (model, the column holding its exchange)
+LEDGER_KINDS = collections.OrderedDict([('c', (wm.Credit, wm.Credit.reference)), ('d', (wm.Debit, wm.Debit.reference)),
+                                        ('t', (em.Trade, em.Trade.exchange))])
+
+
+def _keyed_ledger_entries(kind, query):
+    for entry in query:
+        yield (entry.time.replace(microsecond=0), kind, entry.id), entry
+
+
+def _filter_ledger_after(query, model, kind, after):
+    """
+    Filter a query for entries of one kind that come after the (time, kind, id) ledger key given.
+    """
+    second, akind, aid = after
+    next_second = second + datetime.timedelta(seconds=1)
+    if kind > akind:
+        return query.filter(model.time >= second)
+    elif kind < akind:
+        return query.filter(model.time >= next_second)
+    return query.filter(sa.or_(model.time >= next_second,
+                               sa.and_(model.time >= second, model.time < next_second, model.id > aid)))
+
+
+def ledger_query(session, kind, exchange=None, after=None):
+    """
+    Build the query for one kind of ledger entry, in ledger order.
+
+    :param str kind: 'c' for credits, 'd' for debits or 't' for trades.
+    :param str exchange: The exchange to filter for. (optional)
+    :param tuple after: Only include entries after this (time, kind, id) ledger key. (optional)
+    """
+    model, refcol = LEDGER_KINDS[kind]
+    query = session.query(model)
+    if exchange is not None:
+        query = query.filter(refcol == exchange)
+    if after is not None:
+        query = _filter_ledger_after(query, model, kind, after)
+    return query.order_by(sa.func.date_trunc('second', model.time), model.id)
+
+
+def iter_ledger_entries(exchange=None, session=None, after=None):
+    """
+    Iterate over every credit, debit and trade in ledger order, without loading them all into memory.
+    Each kind is ordered by the database and streamed with a server side cursor, then the three are merged.
+    Entries are ordered by time to the second, then credits, debits and trades, then id.
+
+    :param str exchange: The exchange to filter for. (optional)
+    :param session: The sqlalchemy session.
+    :param tuple after: Only include entries after this (time, kind, id) ledger key. (optional)
+    :return: A generator of ((time, kind, id), entry) tuples.
+    """
+    with session_scope(session) as session:
+        streams = []
+        for kind in LEDGER_KINDS:
+            query = ledger_query(session, kind, exchange, after).yield_per(LEDGER_PAGE_SIZE)
+            streams.append(_keyed_ledger_entries(kind, query))
+        for keyed in heapq.merge(*streams):
+            yield keyed
+
+
+def iter_ledger(exchange=None, session=None):
+    """
+    Iterate over the ledger-cli style entries for the given exchange.
+
+    :param str exchange: The exchange to filter for. (optional)
+    :param session: The sqlalchemy session.
+    :return: A generator of ledger entry strings.
+    """
+    for key, entry in iter_ledger_entries(exchange=exchange, session=session):
+        yield entry.get_ledger_entry()
+
+
+def write_ledger(out, exchange=None, session=None):
+    """
+    Write a ledger-cli style ledger for the given exchange to a file, one entry at a time.
+
+    :param out: The file object to write to.
+    :param str exchange: The exchange to filter for. (optional)
+    :param session: The sqlalchemy session.
+    :rtype: int
+    :return: The number of entries written.
+    """
+    count = 0
+    for entry in iter_ledger(exchange=exchange, session=session):
+        out.write(entry)
+        count += 1
+    out.flush()
+    return count
+
+
+def make_ledger(exchange=None, session=None):
     """
     Make a ledger-cli style ledger for the given exchange.
     Accounts for all trades, debits and credits in the database.
@@ -643,27 +1826,95 @@ def make_ledger(exchange=None, session=ses):
     :rtype: str
     :return: The ledger string.
     """
-    ledger = ""
-    trades = session.query(em.Trade)
-    credits = session.query(wm.Credit)
-    debits = session.query(wm.Debit)
-    if exchange is not None:
-        trades = trades.filter(em.Trade.exchange == exchange)
-        credits = credits.filter(wm.Credit.reference == exchange)
-        debits = debits.filter(wm.Debit.reference == exchange)
-    entries = collections.OrderedDict()
-
-    for credit in credits:
-        timmy = "%s.c%s" % (int(time.mktime(credit.time.timetuple())), credit.id)
-        entries[timmy] = credit
-    for debit in debits:
-        timmy = "%s.d%s" % (int(time.mktime(debit.time.timetuple())), debit.id)
-        entries[timmy] = debit
-    for trade in trades:
-        timmy = "%s.t%s" % (int(time.mktime(trade.time.timetuple())), trade.id)
-        entries[timmy] = trade
-
-    for entry in sorted(entries):
-        ledger += entries[entry].get_ledger_entry()
-
-    return ledger
+    return "".join(iter_ledger(exchange=exchange, session=session))
+
+
+def read_ledger_checkpoint(path):
+    """
+    Read the checkpoint of a persisted ledger file.
+
+    :param str path: The path of the ledger file.
+    :return: The checkpoint dict, or None if there is none.
+    """
+    try:
+        with open("%s.checkpoint" % path, 'r') as cpfile:
+            checkpoint = json.load(cpfile)
+    except (IOError, ValueError):
+        return None
+    if checkpoint.get('time') is not None:
+        checkpoint['time'] = datetime.datetime.strptime(checkpoint['time'], '%Y-%m-%dT%H:%M:%S')
+    return checkpoint
+
+
+def _write_ledger_checkpoint(path, checkpoint):
+    checkpoint = dict(checkpoint)
+    if checkpoint.get('time') is not None:
+        checkpoint['time'] = checkpoint['time'].strftime('%Y-%m-%dT%H:%M:%S')
+    tmppath = "%s.checkpoint.tmp" % path
+    with open(tmppath, 'w') as cpfile:
+        json.dump(checkpoint, cpfile)
+    os.rename(tmppath, "%s.checkpoint" % path)
+
+
+def update_ledger_file(path, exchange=None, session=None, rebuild=False):
+    """
+    Append new entries to a persisted ledger file, using the checkpoint saved beside it to find where it left off.
+    If there is no usable checkpoint, or rebuild is True, the whole ledger is rewritten.
+
+    :param str path: The path of the ledger file.
+    :param str exchange: The exchange to filter for. (optional)
+    :param session: The sqlalchemy session.
+    :param bool rebuild: Rewrite the whole ledger file. (optional)
+    :rtype: int
+    :return: The number of entries written.
+    """
+    checkpoint = None if rebuild else read_ledger_checkpoint(path)
+    if checkpoint is not None:
+        if checkpoint.get('exchange') != exchange:
+            raise ValueError("ledger %s is for exchange %s, not %s" % (path, checkpoint.get('exchange'), exchange))
+        if not os.path.exists(path) or os.path.getsize(path) < checkpoint['size']:
+            checkpoint = None  # the file is missing or was truncated
+    if checkpoint is None:
+        checkpoint = {'exchange': exchange, 'time': None, 'kind': None, 'id': None, 'entries': 0, 'size': 0}
+        out = open(path, 'w')
+    else:
+        out = open(path, 'r+')
+        out.seek(checkpoint['size'])
+        out.truncate()  # discard anything written after the last checkpoint
+    after = (checkpoint['time'], checkpoint['kind'], checkpoint['id']) if checkpoint['time'] is not None else None
+    count = 0
+    try:
+        for key, entry in iter_ledger_entries(exchange=exchange, session=session, after=after):
+            out.write(entry.get_ledger_entry())
+            after = key
+            count += 1
+        out.flush()
+        os.fsync(out.fileno())
+        size = out.tell()
+    finally:
+        out.close()
+    if after is not None:
+        checkpoint['time'], checkpoint['kind'], checkpoint['id'] = after
+    checkpoint['entries'] += count
+    checkpoint['size'] = size
+    _write_ledger_checkpoint(path, checkpoint)
+    return count
+
+
+def verify_ledger_file(path, exchange=None, session=None):
+    """
+    Check that a persisted ledger file matches a fresh rendering of the ledger, one entry at a time.
+
+    :param str path: The path of the ledger file.
+    :param str exchange: The exchange to filter for. (optional)
+    :param session: The sqlalchemy session.
+    :rtype: bool
+    :return: True if the file matches, otherwise False.
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r') as ledger:
+        for entry in iter_ledger(exchange=exchange, session=session):
+            if ledger.read(len(entry)) != entry:
+                return False
+        return ledger.read(1) == ''
@@ -0,0 +1,96 @@
+"""
+A graph of live tickers, for pricing commodities that have no direct market with the quote currency.
+Each market is an edge between its base and quote commodities, in both directions.
+The cost of an edge is the log of its spread (ask / bid) plus a fixed HOP_COST, so the best path is the one
+that loses the least to spreads and takes the fewest hops. Volume breaks ties between otherwise equal markets.
+"""
+import heapq
+import math
+
+# added to the cost of every edge, so a short path wins over a long one with similar spreads
+HOP_COST = 0.001
+
+
+class PriceGraph(object):
+    """
+    A price graph, built from a list of Tickers.
+    Rates found are cached for the life of the graph, so build a new graph for new tickers.
+    """
+
+    def __init__(self, tickers=None):
+        # commodity -> neighbour -> (cost, -volume, rate, ticker)
+        self.edges = {}
+        self.rates = {}
+        for ticker in tickers or []:
+            self.add_ticker(ticker)
+
+    def add_ticker(self, ticker):
+        """
+        Add a market to the graph, keeping only the best market between any two commodities.
+
+        :param Ticker ticker: The ticker to add.
+        """
+        if ticker is None:
+            return
+        base, quote = ticker.market.split("_")
+        bid = ticker.bid.to_double()
+        ask = ticker.ask.to_double()
+        index = ticker.calculate_index().to_double()
+        if bid <= 0 or ask <= 0 or index <= 0:
+            return
+        cost = max(math.log(ask / bid), 0.0) + HOP_COST
+        volume = ticker.volume.to_double()
+        for src, dst, rate in ((base, quote, index), (quote, base, 1.0 / index)):
+            edge = (cost, -volume, rate, ticker)
+            current = self.edges.setdefault(src, {}).get(dst)
+            if current is None or edge[:2] < current[:2]:
+                self.edges[src][dst] = edge
+        self.rates = {}
+
+    def _find_hops(self, base, quote):
+        """
+        Dijkstra's shortest path from base to quote.
+
+        :return: The list of commodities along the path, or None if there is no path.
+        """
+        best = {base: 0.0}
+        queue = [(0.0, 0.0, base, [base])]
+        while len(queue) > 0:
+            cost, volume, comm, hops = heapq.heappop(queue)
+            if comm == quote:
+                return hops
+            if cost > best.get(comm, float('inf')):
+                continue
+            for dst, (ecost, evolume, rate, ticker) in self.edges.get(comm, {}).items():
+                ncost = cost + ecost
+                if ncost < best.get(dst, float('inf')):
+                    best[dst] = ncost
+                    heapq.heappush(queue, (ncost, volume + evolume, dst, hops + [dst]))
+
+    def get_path(self, base, quote):
+        """
+        Find the cheapest conversion path from base to quote.
+
+        :return: The list of Tickers to convert through, or None if there is no path.
+        :rtype: list
+        """
+        hops = self._find_hops(base, quote)
+        if hops is None:
+            return None
+        return [self.edges[src][dst][3] for src, dst in zip(hops, hops[1:])]
+
+    def get_rate(self, base, quote):
+        """
+        Get the rate to convert one unit of base into quote, along the cheapest path.
+
+        :return: The rate as a float, or None if there is no path.
+        """
+        if (base, quote) not in self.rates:
+            hops = self._find_hops(base, quote)
+            rate = None
+            if hops is not None:
+                rate = 1.0
+                for src, dst in zip(hops, hops[1:]):
+                    rate *= self.edges[src][dst][2]
+            self.rates[(base, quote)] = rate
+        return self.rates[(base, quote)]
@@ -0,0 +1,77 @@
+"""
+Order ladder reconciliation. Compares the orders a strategy wants on one side of a market
+against the orders already open there, so only the differences need to be sent to the exchange.
+"""
+
+# relative price difference within which an open order is considered to be at a desired price level
+PRICE_TOLERANCE = 0.001
+# relative size difference within which an open order at the right price is kept as is
+SIZE_TOLERANCE = 0.05
+
+
+def _to_float(value):
+    return value.to_double() if hasattr(value, 'to_double') else float(value)
+
+
+def _within(a, b, tolerance):
+    return abs(a - b) <= tolerance * max(abs(a), abs(b))
+
+
+def remaining_amount(order):
+    """
+    :return: The unexecuted amount of a LimitOrder, as a float.
+    """
+    executed = _to_float(order.exec_amount) if order.exec_amount is not None else 0.0
+    return _to_float(order.amount) - executed
+
+
+def locked_amounts(orders):
+    """
+    Sum the funds held by open orders. An ask holds its remaining base amount, a bid the quote it would spend.
+
+    :param list orders: The open LimitOrders.
+    :return: A dict of commodity -> locked amount, as floats.
+    :rtype: dict
+    """
+    locked = {}
+    for order in orders:
+        base, quote = order.market.split("_")
+        if order.side == 'ask':
+            locked[base] = locked.get(base, 0.0) + remaining_amount(order)
+        else:
+            locked[quote] = locked.get(quote, 0.0) + remaining_amount(order) * _to_float(order.price)
+    return locked
+
+
+def reconcile_orders(desired, current, price_tolerance=PRICE_TOLERANCE, size_tolerance=SIZE_TOLERANCE):
+    """
+    Diff a desired ladder against the open orders on the same market and side.
+    Each price level is matched to the nearest unmatched open order within price_tolerance.
+    A matched order within size_tolerance of the level's amount is kept, otherwise it is amended.
+
+    :param list desired: (price, amount) tuples, as Amounts or floats.
+    :param list current: The open LimitOrders.
+    :return: A dict with 'keep' (orders to leave alone), 'cancel' (orders to cancel), 'create' ((price, amount)
+             levels to place) and 'amend' ((order, (price, amount)) pairs to replace).
+    :rtype: dict
+    """
+    result = {'keep': [], 'cancel': [], 'create': [], 'amend': []}
+    unmatched = list(current)
+    for level in sorted(desired, key=lambda lvl: _to_float(lvl[0])):
+        price = _to_float(level[0])
+        best = None
+        for order in unmatched:
+            oprice = _to_float(order.price)
+            if _within(price, oprice, price_tolerance) and \
+                    (best is None or abs(oprice - price) < abs(_to_float(best.price) - price)):
+                best = order
+        if best is None:
+            result['create'].append(level)
+            continue
+        unmatched.remove(best)
+        if _within(_to_float(level[1]), remaining_amount(best), size_tolerance):
+            result['keep'].append(best)
+        else:
+            result['amend'].append((best, level))
+    result['cancel'].extend(unmatched)
+    return result